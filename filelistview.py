@@ -35,13 +35,29 @@ from . import (
 
 if hglib.TYPE_CHECKING:
     from typing import (
+        Dict,
         List,
         Optional,
+        Tuple,
+    )
+    from .qtcore import (
+        QSize,
     )
     from .qtgui import (
         QWidget,
     )
 
+_smalliconsize = None  # type: Optional[QSize]
+
+def _smallIconSize():
+    # type: () -> QSize
+    # the style metric doesn't change during the session, so query it once
+    # (QApplication must exist, hence not computed at import time)
+    global _smalliconsize
+    if _smalliconsize is None:
+        _smalliconsize = qtlib.smallIconSize()
+    return _smalliconsize
+
 
 class HgFileListView(QTreeView):
     """Display files and statuses between two revisions or patch"""
@@ -59,9 +75,15 @@ class HgFileListView(QTreeView):
         self.setTextElideMode(Qt.ElideLeft)
 
         # give consistent height and enable optimization
-        self.setIconSize(qtlib.smallIconSize())
+        self.setIconSize(_smallIconSize())
         self.setUniformRowHeights(True)
 
+        # selected file paths keyed by QModelIndex.internalId(), which is
+        # only valid until the model nodes are rebuilt
+        self._pathcache = {}  # type: Dict[int, bytes]
+        # (path, status) last sent by fileSelected, to drop duplicates
+        self._lastemitted = None  # type: Optional[Tuple[str, str]]
+
     def _model(self):
         # type: () -> manifestmodel.ManifestModel
         model = self.model()
@@ -71,7 +93,11 @@ class HgFileListView(QTreeView):
     def setModel(self, model):
         # type: (manifestmodel.ManifestModel) -> None
         QTreeView.setModel(self, model)
+        model.layoutAboutToBeChanged.connect(self._onLayoutAboutToBeChanged)
         model.layoutChanged.connect(self._onLayoutChanged)
+        model.modelReset.connect(self._invalidatePathCache)
+        model.rowsInserted.connect(self._invalidatePathCache)
+        model.rowsRemoved.connect(self._invalidatePathCache)
         model.revLoaded.connect(self._onRevLoaded)
         self.selectionModel().currentRowChanged.connect(self._emitFileChanged)
 
@@ -84,14 +110,27 @@ class HgFileListView(QTreeView):
     def setCurrentFile(self, path):
         # type: (bytes) -> None
         model = self._model()
-        model.fetchMore(QModelIndex())  # make sure path is populated
-        self.setCurrentIndex(model.indexFromPath(hglib.tounicode(path)))
+        upath = hglib.tounicode(path)
+        index = model.indexFromPath(upath)
+        if not index.isValid() and model.canFetchMore(QModelIndex()):
+            model.fetchMore(QModelIndex())  # make sure path is populated
+            index = model.indexFromPath(upath)
+        self.setCurrentIndex(index)
 
     def getSelectedFiles(self):
         # type: () -> List[bytes]
-        model = self._model()
-        return [hglib.fromunicode(model.filePath(index))
-                for index in self.selectedRows()]
+        fu = hglib.fromunicode
+        filePath = self._model().filePath
+        cache = self._pathcache
+        files = []
+        for index in self.selectedRows():
+            key = index.internalId()
+            try:
+                path = cache[key]
+            except KeyError:
+                cache[key] = path = fu(filePath(index))
+            files.append(path)
+        return files
 
     def _initCurrentIndex(self):
         # type: () -> None
@@ -99,11 +138,25 @@ class HgFileListView(QTreeView):
         if m.rowCount() > 0:
             self.setCurrentIndex(m.index(0, 0))
         else:
+            self._lastemitted = None
             self.clearDisplay.emit()
 
+    @pyqtSlot()
+    def _onLayoutAboutToBeChanged(self):
+        # type: () -> None
+        # repaint once after the whole tree is rebuilt, not per relayout
+        self.setUpdatesEnabled(False)
+
+    @pyqtSlot()
+    def _invalidatePathCache(self):
+        # type: () -> None
+        self._pathcache.clear()
+
     @pyqtSlot()
     def _onLayoutChanged(self):
         # type: () -> None
+        self._invalidatePathCache()
+        self.setUpdatesEnabled(True)
         index = self.currentIndex()
         if index.isValid():
             self.scrollTo(index)
@@ -115,7 +168,8 @@ class HgFileListView(QTreeView):
         # type: () -> None
         index = self.currentIndex()
         if index.isValid():
-            # redisplay previous row
+            # redisplay previous row, which is the same path of new revision
+            self._lastemitted = None
             self._emitFileChanged()
         else:
             self._initCurrentIndex()
@@ -129,8 +183,14 @@ class HgFileListView(QTreeView):
             # TODO: delete status from fileSelected because it isn't primitive
             # pseudo directory node has no status
             st = m.fileStatus(index) or ''
-            self.fileSelected.emit(m.filePath(index), st)
+            selected = (m.filePath(index), st)
+            if selected == self._lastemitted:
+                # e.g. current row re-notified after layout change
+                return
+            self._lastemitted = selected
+            self.fileSelected.emit(*selected)
         else:
+            self._lastemitted = None
             self.clearDisplay.emit()
 
     def selectedRows(self):
@@ -7,6 +7,8 @@
 
 from __future__ import absolute_import
 
+import os
+
 from .qtcore import (
     QSettings,
     QTimer,
@@ -38,9 +40,11 @@ from . import (
 if hglib.TYPE_CHECKING:
     from typing import (
         Any,
+        Dict,
         List,
         Optional,
         Text,
+        Tuple,
     )
     from .qtgui import (
         QWidget,
@@ -64,14 +68,24 @@ class GraftDialog(QDialog):
         self._repoagent = repoagent
         self._cmdsession = cmdcore.nullCmdSession()
         self.valid = True
-
-        self.sourcelist = [
-            hglib.revsymbol(self.repo, hglib.fromunicode(rev)).rev()
-            for rev in opts.get('source', ['.'])]
+        self._sourcerevindex = None  # type: Optional[Dict[int, int]]
+        self._mergestatuscache = (None, None)
+
+        # re-grafts may list the same revision more than once
+        revcache = {}  # type: Dict[bytes, int]
+        def resolverev(rev):
+            # type: (bytes) -> int
+            try:
+                return revcache[rev]
+            except KeyError:
+                revcache[rev] = r = hglib.revsymbol(self.repo, rev).rev()
+                return r
+
+        self.sourcelist = [resolverev(hglib.fromunicode(rev))
+                           for rev in opts.get('source', ['.'])]
         currgraftrevs = self.graftstate()
         if currgraftrevs:
-            currgraftrevs = [hglib.revsymbol(self.repo, rev).rev()
-                             for rev in currgraftrevs]
+            currgraftrevs = [resolverev(rev) for rev in currgraftrevs]
             if self.sourcelist != currgraftrevs:
                 res = qtlib.CustomPrompt(_('Interrupted graft operation found'),
                     _('An interrupted graft operation has been found.\n\n'
@@ -254,6 +268,7 @@ class GraftDialog(QDialog):
     @pyqtSlot(int)
     def _graftFinished(self, ret):
         # type: (int) -> None
+        self._invalidateMergeStatus()
         if self.checkResolve() is False:
             msg = _('Graft is complete')
             if ret == 255:
@@ -267,6 +282,7 @@ class GraftDialog(QDialog):
     @pyqtSlot()
     def _abortFinished(self):
         # type: () -> None
+        self._invalidateMergeStatus()
         if self.checkResolve() is False:
             self._stbar.showMessage(_('Graft aborted'))
             self._makeCloseButton()
@@ -278,9 +294,45 @@ class GraftDialog(QDialog):
         self.graftbtn.clicked.disconnect(self.graft)
         self.graftbtn.clicked.connect(self.accept)
 
+    def _sourceRevIndex(self):
+        # type: () -> Dict[int, int]
+        """Map of source revision number to its position in sourcelist"""
+        if self._sourcerevindex is None:
+            self._sourcerevindex = {self.repo[r].rev(): n
+                                    for n, r in enumerate(self.sourcelist)}
+        return self._sourcerevindex
+
+    def _mergeStatusStamp(self):
+        # type: () -> Tuple[Optional[float], Optional[float]]
+        stamp = []
+        for f in (b'dirstate', b'merge/state'):
+            try:
+                stamp.append(os.path.getmtime(self.repo.vfs.join(f)))
+            except OSError:
+                stamp.append(None)
+        return tuple(stamp)
+
+    def _mergeStatus(self):
+        # type: () -> List[Tuple[bytes, bytes, bytes]]
+        """Merge status of the repository and its subrepos
+
+        The result is reused until the dirstate or merge state is touched,
+        or the cache is explicitly invalidated.
+        """
+        stamp = self._mergeStatusStamp()
+        cachedstamp, mstatus = self._mergestatuscache
+        if mstatus is None or cachedstamp != stamp:
+            mstatus = list(thgrepo.recursiveMergeStatus(self.repo))
+            self._mergestatuscache = (stamp, mstatus)
+        return mstatus
+
+    def _invalidateMergeStatus(self):
+        # type: () -> None
+        self._mergestatuscache = (None, None)
+
     def checkResolve(self):
         # type: () -> bool
-        for root, path, status in thgrepo.recursiveMergeStatus(self.repo):
+        for root, path, status in self._mergeStatus():
             if status == b'u':
                 txt = _('Graft generated merge <b>conflicts</b> that must '
                         'be <a href="resolve"><b>resolved</b></a>')
@@ -293,14 +345,8 @@ class GraftDialog(QDialog):
 
         currgraftrevs = self.graftstate()
         if currgraftrevs:
-            def findrev(rev, revlist):
-                rev = self.repo[rev].rev()
-                for n, r in enumerate(revlist):
-                    r = self.repo[r].rev()
-                    if rev == r:
-                        return n
-                return None
-            idx = findrev(currgraftrevs[0], self.sourcelist)
+            rev = self.repo[currgraftrevs[0]].rev()
+            idx = self._sourceRevIndex().get(rev)
             if idx is not None:
                 self._updateSource(idx)
             self.abortbtn.setEnabled(True)
@@ -315,6 +361,8 @@ class GraftDialog(QDialog):
         if cmd == 'resolve':
             dlg = resolve.ResolveDialog(self._repoagent, self)
             dlg.exec_()
+            # subrepo merge states are not covered by the cache stamp
+            self._invalidateMergeStatus()
             self.checkResolve()
         else:
             self._wctxcleaner.runCleaner(cmd)
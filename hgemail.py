@@ -470,6 +470,10 @@ class _ChangesetsModel(QAbstractTableModel):
         self._selectedrevs = set()
         self.updateAll()
 
+    def setSelectedRevs(self, revs):
+        self._selectedrevs = set(revs)
+        self.updateAll()
+
     def updateAll(self):
         first = self.createIndex(0, 0)
         last = self.createIndex(len(self._revs) - 1, 0)
@@ -12,10 +12,16 @@ import re
 
 from .qtcore import (
     QEvent,
+    QItemSelection,
+    QItemSelectionModel,
+    QModelIndex,
     QSettings,
+    QStringListModel,
+    QThread,
     QTimer,
     Qt,
     pyqtSignal,
+    pyqtSlot,
 )
 from .qtgui import (
     QAbstractItemView,
@@ -26,7 +32,7 @@ from .qtgui import (
     QHBoxLayout,
     QLabel,
     QLineEdit,
-    QListWidget,
+    QListView,
     QMenu,
     QPushButton,
     QSplitter,
@@ -40,6 +46,7 @@ from hgext.largefiles import (
 from mercurial import (
     commands,
     error,
+    hg,
     match,
     util,
 )
@@ -54,13 +61,28 @@ from . import (
     qtlib,
 )
 
+_MAX_CACHED_MENUS = 32
+
+# an ignore file is line based, so a pattern can't contain newline or NUL
+_validpatre = re.compile(br'[^\0\r\n]+\Z')
+
+def _decodecached(lines, cache):
+    """Decode lines to unicode, reusing strings decoded on the last call
+
+    The cache is updated to hold the given lines only.
+    """
+    uni = hglib.tounicode
+    get = cache.get
+    decoded = [get(l) or uni(l) for l in lines]
+    cache.clear()
+    cache.update(zip(lines, decoded))
+    return decoded
+
 class HgignoreDialog(QDialog):
     'Edit a repository .hgignore file'
 
     ignoreFilterUpdated = pyqtSignal()
 
-    contextmenu = None
-
     def __init__(self, repoagent, parent=None, *pats):
         'Initialize the Dialog'
         QDialog.__init__(self, parent)
@@ -70,6 +92,13 @@ class HgignoreDialog(QDialog):
 
         self._repoagent = repoagent
         self.pats = pats
+        self.ignorelines = []
+        self._syntaxsections = {}
+        # decoded text of lines shown by the last refresh
+        self._ignorelinecache = {}
+        self._unknowncache = {}
+        # context menus keyed by tuple of selected files, oldest first
+        self._menucache = {}
         self.setWindowTitle(_('Ignore filter - %s') % repoagent.displayName())
         self.setWindowIcon(qtlib.geticon('thg-ignore'))
 
@@ -128,20 +157,28 @@ class HgignoreDialog(QDialog):
         unknowngb = QGroupBox()
         uvbox = QVBoxLayout()
         unknowngb.setLayout(uvbox)
-        lbl = QLabel(_('<b>Untracked Files</b>'))
+        self.unknownlabel = lbl = QLabel(_('<b>Untracked Files</b>'))
         uvbox.addWidget(lbl)
         split.addWidget(unknowngb)
 
-        ignorelist = QListWidget()
+        self._ignoremodel = QStringListModel(self)
+        ignorelist = QListView()
+        ignorelist.setModel(self._ignoremodel)
+        # rows mirror ignorelines and the file, so no in-place editing
+        ignorelist.setEditTriggers(QAbstractItemView.NoEditTriggers)
         ivbox.addWidget(ignorelist)
         ignorelist.setSelectionMode(QAbstractItemView.ExtendedSelection)
-        unknownlist = QListWidget()
+        self._unknownmodel = QStringListModel(self)
+        unknownlist = QListView()
+        unknownlist.setModel(self._unknownmodel)
+        unknownlist.setEditTriggers(QAbstractItemView.NoEditTriggers)
         uvbox.addWidget(unknownlist)
         unknownlist.setSelectionMode(QAbstractItemView.ExtendedSelection)
-        unknownlist.currentTextChanged.connect(self.setGlobFilter)
+        unknownlist.selectionModel().currentChanged.connect(
+            self._onUnknownCurrentChanged)
         unknownlist.setContextMenuPolicy(Qt.CustomContextMenu)
         unknownlist.customContextMenuRequested.connect(self.menuRequest)
-        unknownlist.itemDoubleClicked.connect(self.unknownDoubleClicked)
+        unknownlist.doubleClicked.connect(self.unknownDoubleClicked)
         lbl = QLabel(_('Backspace or Del to remove row(s)'))
         ivbox.addWidget(lbl)
 
@@ -158,6 +195,13 @@ class HgignoreDialog(QDialog):
         self.le, self.recombo, self.filecombo = le, recombo, filecombo
         self.ignorelist, self.unknownlist = ignorelist, unknownlist
         ignorelist.installEventFilter(self)
+
+        self.lclunknowns = []
+        self._rescanpending = False
+        # True from starting a scan until _onScanFinished() has read it
+        self._scanning = False
+        self._statusthread = UnknownFilesThread(repo, self)
+        self._statusthread.finished.connect(self._onScanFinished)
         QTimer.singleShot(0, self.refresh)
 
         s = QSettings()
@@ -174,10 +218,11 @@ class HgignoreDialog(QDialog):
             return False
         elif event.key() not in (Qt.Key_Backspace, Qt.Key_Delete):
             return False
-        if obj.currentRow() < 0:
+        if not obj.currentIndex().isValid():
             return False
-        for idx in sorted(obj.selectedIndexes(), reverse=True):
-            self.ignorelines.pop(idx.row())
+        drop = {idx.row() for idx in obj.selectionModel().selectedIndexes()}
+        self.ignorelines = [l for i, l in enumerate(self.ignorelines)
+                            if i not in drop]
         self.writeIgnoreFile()
         self.refresh()
         return True
@@ -185,59 +230,81 @@ class HgignoreDialog(QDialog):
     def menuRequest(self, point):
         'context menu request for unknown list'
         point = self.unknownlist.viewport().mapToGlobal(point)
-        selected = [self.lclunknowns[i.row()]
-                    for i in sorted(self.unknownlist.selectedIndexes())]
+        selmodel = self.unknownlist.selectionModel()
+        selected = tuple(self.lclunknowns[i.row()]
+                         for i in sorted(selmodel.selectedIndexes()))
         if len(selected) == 0:
             return
-        if not self.contextmenu:
-            self.contextmenu = QMenu(self)
-            self.contextmenu.setTitle(_('Add ignore filter...'))
-        else:
-            self.contextmenu.clear()
+        menu = self._menucache.get(selected)
+        if menu is None:
+            if len(self._menucache) >= _MAX_CACHED_MENUS:
+                oldest = next(iter(self._menucache))
+                self._menucache.pop(oldest).deleteLater()
+            menu = self._menucache[selected] = self._buildMenu(selected)
+        menu.exec_(point)
+
+    def _buildMenu(self, selected):
+        'build context menu offering ignore filters for the selected files'
+        uni = hglib.tounicode
+        menu = QMenu(self)
+        menu.setTitle(_('Add ignore filter...'))
         filters = []
         if len(selected) == 1:
             local = selected[0]
             filters.append([local])
-            dirname = os.path.dirname(local)
-            while dirname:
-                filters.append([dirname])
-                dirname = os.path.dirname(dirname)
+            # repository paths are always '/'-separated
+            parts = local.split(b'/')
+            filters.extend([b'/'.join(parts[:i])]
+                           for i in range(len(parts) - 1, 0, -1))
             base, ext = os.path.splitext(local)
             if ext:
-                ext = hglib.tounicode(ext)
+                ext = uni(ext)
                 filters.append(['*'+ext])
                 filters.append(['**'+ext])
         else:
-            filters.append(selected)
+            filters.append(list(selected))
         for f in filters:
             n = len(f) == 1 and f[0] or _('selected files')
-            a = self.contextmenu.addAction(_('Ignore ') + hglib.tounicode(n))
+            a = menu.addAction(_('Ignore ') + uni(n))
             a._patterns = f
             a.triggered.connect(self.insertFilters)
-        self.contextmenu.exec_(point)
+        return menu
 
-    def unknownDoubleClicked(self, item):
-        self.insertFilters([hglib.fromunicode(item.text())])
+    @pyqtSlot(QModelIndex)
+    def unknownDoubleClicked(self, index):
+        self.insertFilters([self.lclunknowns[index.row()]])
 
     def insertFilters(self, pats=None, isregexp=False):
         if not pats:
             pats = self.sender()._patterns
         h = isregexp and b'syntax: regexp' or b'syntax: glob'
-        if h in self.ignorelines:
-            l = self.ignorelines.index(h)
-            for i, line in enumerate(self.ignorelines[l+1:]):
-                if line.startswith(b'syntax:'):
-                    for pat in pats:
-                        self.ignorelines.insert(l+i+1, pat)
-                    break
-            else:
-                self.ignorelines.extend(pats)
+        # refresh() rescans the sections from the updated lines
+        if h in self._syntaxsections:
+            end = self._syntaxsections[h][1]
+            self.ignorelines[end:end] = pats
         else:
             self.ignorelines.append(h)
             self.ignorelines.extend(pats)
         self.writeIgnoreFile()
         self.refresh()
 
+    def _scanSyntaxSections(self):
+        'Map each syntax header to the line range of its first section'
+        sections = {}
+        header = start = None
+        for i, line in enumerate(self.ignorelines):
+            if line.startswith(b'syntax:'):
+                if header is not None:
+                    sections.setdefault(header, (start, i))
+                header, start = line.rstrip(), i
+        if header is not None:
+            sections.setdefault(header, (start, len(self.ignorelines)))
+        self._syntaxsections = sections
+
+    @pyqtSlot(QModelIndex, QModelIndex)
+    def _onUnknownCurrentChanged(self, current, previous):
+        self.setGlobFilter(current.data() or '')
+
     def setGlobFilter(self, qstr):
         'user selected an unknown file; prep a glob filter'
         self.recombo.setCurrentIndex(0)
@@ -258,82 +325,141 @@ class HgignoreDialog(QDialog):
         if newfilter == b'':
             return
         self.le.clear()
-        if self.recombo.currentIndex() == 0:
-            test = b'glob:' + newfilter
+        isregexp = self.recombo.currentIndex() != 0
+        if isregexp:
+            title = _('Invalid regexp expression')
+        else:
+            title = _('Invalid glob expression')
+        if not _validpatre.match(newfilter):
+            qtlib.WarningMsgBox(title, _('invalid pattern: %s')
+                                % hglib.tounicode(newfilter), parent=self)
+            return
+        if isregexp:
+            # compile the regexp directly rather than building a matcher
             try:
-                match.match(self.repo.root, b'', [], [test])
-                self.insertFilters([newfilter], False)
-            except error.Abort as inst:
-                qtlib.WarningMsgBox(_('Invalid glob expression'), str(inst),
-                                    parent=self)
+                re.compile(newfilter)
+            except re.error as inst:
+                qtlib.WarningMsgBox(title, str(inst), parent=self)
                 return
         else:
-            test = b'relre:' + newfilter
             try:
-                match.match(self.repo.root, b'', [], [test])
-                re.compile(test)
-                self.insertFilters([newfilter], True)
-            except (error.Abort, re.error) as inst:
-                qtlib.WarningMsgBox(_('Invalid regexp expression'), str(inst),
-                                    parent=self)
+                match.match(self.repo.root, b'', [], [b'glob:' + newfilter])
+            except error.Abort as inst:
+                qtlib.WarningMsgBox(title, str(inst), parent=self)
                 return
+        self.insertFilters([newfilter], isregexp)
 
     def refresh(self):
         try:
             with open(self.ignorefile, 'rb') as fp:
-                l = fp.readlines()
-            self.doseoln = l[0].endswith(b'\r\n')
-        except (IOError, ValueError, IndexError):
+                raw = fp.read()
+        except (IOError, ValueError):
+            raw = b''
+        if raw:
+            self.doseoln = b'\r\n' in raw[:4096]
+        else:
             self.doseoln = os.name == 'nt'
-            l = []
-        self.ignorelines = [line.strip() for line in l]
-        self.ignorelist.clear()
+        # split like readlines() would, which leaves no empty last line
+        lines = raw.split(b'\n')
+        if not lines[-1]:
+            lines.pop()
+        self.ignorelines = [line.strip() for line in lines]
+        self._scanSyntaxSections()
+
+        decoded = _decodecached(self.ignorelines, self._ignorelinecache)
+
+        # suppress per-row repaints and signals while repopulating
+        w = self.ignorelist
+        w.setUpdatesEnabled(False)
+        w.blockSignals(True)
+        try:
+            self._ignoremodel.setStringList(decoded)
+        finally:
+            w.blockSignals(False)
+            w.setUpdatesEnabled(True)
 
-        uni = hglib.tounicode
+        if not self.pats:
+            try:
+                self.pats = [self.lclunknowns[i.row()]
+                         for i in
+                         self.unknownlist.selectionModel().selectedIndexes()]
+            except IndexError:
+                self.pats = []
+        self._scanUnknowns()
 
-        self.ignorelist.addItems([uni(l) for l in self.ignorelines])
+    def _scanUnknowns(self):
+        'start listing untracked files in background'
+        if self._scanning:
+            # restart once the current scan finishes, as its result is stale
+            self._rescanpending = True
+            return
+        self.unknownlist.setEnabled(False)
+        self.unknownlabel.setText(_('<b>Untracked Files</b> (scanning...)'))
+        self._scanning = True
+        self._statusthread.start()
+
+    @pyqtSlot()
+    def _onScanFinished(self):
+        self._scanning = False
+        if self._rescanpending:
+            self._rescanpending = False
+            self._scanUnknowns()
+            return
+        self.unknownlabel.setText(_('<b>Untracked Files</b>'))
+        self.unknownlist.setEnabled(True)
 
-        try:
-            self.repo.thginvalidate()
-            with lfutil.lfstatus(self.repo):
-                self.lclunknowns = self.repo.status(unknown=True).unknown
-        except (EnvironmentError, error.RepoError) as e:
-            qtlib.WarningMsgBox(_('Unable to read repository status'),
-                                uni(str(e)), parent=self)
-        except error.Abort as e:
-            if e.hint:
+        uni = hglib.tounicode
+        e = self._statusthread.error
+        if e:
+            if isinstance(e, error.Abort) and e.hint:
                 err = _('%s (hint: %s)') % (uni(str(e)), uni(e.hint))
             else:
                 err = uni(str(e))
             qtlib.WarningMsgBox(_('Unable to read repository status'),
                                 err, parent=self)
-            self.lclunknowns = []
-            return
+        self.lclunknowns = self._statusthread.unknowns
 
-        if not self.pats:
-            try:
-                self.pats = [self.lclunknowns[i.row()]
-                         for i in self.unknownlist.selectedIndexes()]
-            except IndexError:
-                self.pats = []
-        self.unknownlist.clear()
-        self.unknownlist.addItems([uni(u) for u in self.lclunknowns])
+        # suppress per-row repaints and selection signals while repopulating
+        w = self.unknownlist
+        w.setUpdatesEnabled(False)
+        w.blockSignals(True)
+        try:
+            self._populateUnknowns()
+        finally:
+            w.blockSignals(False)
+            w.setUpdatesEnabled(True)
+
+    def _populateUnknowns(self):
+        model = self._unknownmodel
+        model.setStringList(
+            _decodecached(self.lclunknowns, self._unknowncache))
+
+        pats = set(self.pats)
+        sel = QItemSelection()
+        current = None
         for i, u in enumerate(self.lclunknowns):
-            if u in self.pats:
-                item = self.unknownlist.item(i)
-                item.setSelected(True)
-                self.unknownlist.setCurrentItem(item)
-                self.le.setText(hglib.tounicode(u))
+            if u in pats:
+                index = model.index(i, 0)
+                sel.select(index, index)
+                current = index
+        if current is not None:
+            # the selection model isn't blocked; this emits selectionChanged
+            # once and currentChanged updates the glob filter
+            selmodel = self.unknownlist.selectionModel()
+            selmodel.select(sel, QItemSelectionModel.Select)
+            selmodel.setCurrentIndex(current, QItemSelectionModel.NoUpdate)
         self.pats = []
 
     def writeIgnoreFile(self):
         eol = self.doseoln and b'\r\n' or b'\n'
-        out = eol.join(self.ignorelines) + eol
         hasignore = os.path.exists(self.repo.vfs.join(self.ignorefile))
 
         try:
             f = util.atomictempfile(self.ignorefile, b'wb', createmode=None)
-            f.write(out)
+            # write the terminating EOL separately instead of copying the
+            # whole joined buffer just to append it
+            f.write(eol.join(self.ignorelines))
+            f.write(eol)
             f.close()
             if not hasignore:
                 ret = qtlib.QuestionMsgBox(_('New file created'),
@@ -349,12 +475,47 @@ class HgignoreDialog(QDialog):
             qtlib.WarningMsgBox(_('Unable to write .hgignore file'),
                                 hglib.tounicode(str(e)), parent=self)
 
+    def _stopScan(self):
+        'drop pending scans; a running one is left to finish on its own'
+        self._rescanpending = False
+        thread = self._statusthread
+        try:
+            thread.finished.disconnect(self._onScanFinished)
+        except TypeError:
+            return  # already stopped
+        if self._scanning:
+            self._scanning = False
+            qtlib.detachThread(thread)
+
     def accept(self):
+        self._stopScan()
         s = QSettings()
         s.setValue('hgignore/geom', self.saveGeometry())
         QDialog.accept(self)
 
     def reject(self):
+        self._stopScan()
         s = QSettings()
         s.setValue('hgignore/geom', self.saveGeometry())
         QDialog.reject(self)
+
+
+class UnknownFilesThread(QThread):
+    '''Background thread for listing untracked files'''
+
+    def __init__(self, repo, parent=None):
+        super(UnknownFilesThread, self).__init__(parent)
+        self.repo = hg.repository(repo.ui, repo.root)
+        self.unknowns = []
+        self.error = None
+
+    def run(self):
+        self.unknowns = []
+        self.error = None
+        try:
+            self.repo.invalidate()
+            self.repo.invalidatedirstate()
+            with lfutil.lfstatus(self.repo):
+                self.unknowns = self.repo.status(unknown=True).unknown
+        except (EnvironmentError, error.RepoError, error.Abort) as e:
+            self.error = e
@@ -8,10 +8,13 @@
 from __future__ import absolute_import
 
 import os
+from operator import itemgetter
 
 from .qtcore import (
+    QAbstractTableModel,
     QModelIndex,
     QSettings,
+    QThread,
     QTimer,
     Qt,
     pyqtSignal,
@@ -24,13 +27,14 @@ from .qtgui import (
     QKeySequence,
     QLabel,
     QToolBar,
-    QTreeWidget,
-    QTreeWidgetItem,
+    QTreeView,
     QVBoxLayout,
 )
 
 from mercurial import (
+    error,
     extensions,
+    hg,
     pycompat,
     util,
 )
@@ -48,18 +52,23 @@ if hglib.TYPE_CHECKING:
         Dict,
         List,
         Optional,
+        Sequence,
         Text,
+        Tuple,
     )
     from mercurial import localrepo
     from .qtgui import QWidget
     from .thgrepo import RepoAgent
 
 
-_FILE_FILTER = ';;'.join([
-    _('Word docs (*.doc *.docx)'),
-    _('PDF docs (*.pdf)'),
-    _('Excel files (*.xls *.xlsx)'),
-    _('All files (*)')])
+def _file_filter():
+    # type: () -> Text
+    # translated on use, not at import time when the locale may not be set
+    return ';;'.join([
+        _('Word docs (*.doc *.docx)'),
+        _('PDF docs (*.pdf)'),
+        _('Excel files (*.xls *.xlsx)'),
+        _('All files (*)')])
 
 class LockDialog(QDialog):
     showMessage = pyqtSignal(str)
@@ -84,6 +93,15 @@ class LockDialog(QDialog):
 
         self._repoagent = repoagent
         self._cmdsession = cmdcore.nullCmdSession()
+        self._op = 'N/A'  # type: Text
+        self._opfile = None  # type: Optional[Text]
+        self._parsethread = None  # type: Optional[ParseLocksThread]
+        # finished (op, file) pairs waiting for the lock files to be parsed
+        self._parseops = []  # type: List[Tuple[Text, Optional[Text]]]
+        self._pendingreload = False
+        # normalized repository root to test if a path is inside the repo
+        self._rootprefix = os.path.normcase(
+            hglib.tounicode(util.normpath(repoagent.rawRepo().root)) + '/')
 
         self._repoagent.configChanged.connect(self.reload)
 
@@ -111,9 +129,10 @@ class LockDialog(QDialog):
         tb.addAction(a)
 
         lbl = QLabel(_('Locked And Lockable Files:'))
-        self.locktw = tw = QTreeWidget(self)
-        tw.setColumnCount(3)
-        tw.setHeaderLabels([_('Path'), _('Locking User'), _('Purpose')])
+        self._model = LockModel(self)
+        self.locktw = tw = QTreeView(self)
+        tw.setModel(self._model)
+        tw.setUniformRowHeights(True)
         tw.setEnabled(False)
         tw.doubleClicked.connect(self.rowDoubleClicked)
         layout.addWidget(lbl)
@@ -123,10 +142,9 @@ class LockDialog(QDialog):
         layout.addWidget(self._stbar)
         self.showMessage.connect(self._stbar.showMessage)
 
-        s = QSettings()
+        # geometry must be known before show(); the header state is not
+        self._settings = s = QSettings()
         self.restoreGeometry(qtlib.readByteArray(s, 'lock/geom'))
-        self.locktw.header().restoreState(
-            qtlib.readByteArray(s, 'lock/treestate'))
 
         QTimer.singleShot(0, self.finishSetup)
 
@@ -134,6 +152,9 @@ class LockDialog(QDialog):
     def finishSetup(self):
         # type: () -> None
         'complete the setup, some of these steps might fail'
+        # restored first as reject() saves it back
+        self.locktw.header().restoreState(
+            qtlib.readByteArray(self._settings, 'lock/treestate'))
         # this code is specific to simplelock
         try:
             self.sl = extensions.find(b'simplelock')
@@ -145,34 +166,44 @@ class LockDialog(QDialog):
             return
         # this code is specific to simplelock
 
-        self.refillModel()
-        self.reload()
+        self._parsethread = th = ParseLocksThread(self.sl, self.repo, self)
+        th.locksParsed.connect(self._onLocksParsed)
+        th.finished.connect(self._startParse)
 
-    def refillModel(self):
-        # type: () -> Dict[Text, List[Text]]
-        # this code is specific to simplelock
-        locks = self.sl.parseLocks(self.repo)  # type: Dict[bytes, List[bytes]]
-        lockables = self.sl.readlockables(self.repo)  # type: List[bytes]
-        for wfile in lockables:
-            if wfile not in locks:
-                locks[wfile] = [b'', b'']
-        # this code is specific to simplelock
+        # the list is filled when the 'locks' command completes
+        self.reload()
 
-        self.locktw.clear()
-        self.rawrows = sorted([(w, u, p) for w, (u, p) in locks.items()])
-        rows = []
-        for wfile, user, purpose in self.rawrows:
-            uwfile = hglib.tounicode(wfile)
-            uuser = hglib.tounicode(user)
-            upurpose = hglib.tounicode(purpose)
-            rows.append(QTreeWidgetItem([uwfile, uuser, upurpose]))
-        self.locktw.addTopLevelItems(rows)
-        return pycompat.rapply(hglib.tounicode, locks)
+    def refillModel(self, locks):
+        # type: (Dict[bytes, Sequence[bytes]]) -> None
+        # paths are unique keys, so there's no need to compare whole rows
+        items = sorted(locks.items(), key=itemgetter(0))
+        self._model.setRows([(w, u, p) for w, (u, p) in items])
 
     def reject(self):
-        s = QSettings()
-        s.setValue('lock/geom', self.saveGeometry())
-        s.setValue('lock/treestate', self.locktw.header().saveState())
+        try:
+            self._repoagent.configChanged.disconnect(self.reload)
+        except TypeError:
+            pass  # already disconnected
+        self._pendingreload = False
+        sess = self._cmdsession
+        if not sess.isFinished():
+            # don't parse the result of a command aborted by closing
+            sess.commandFinished.disconnect(self.operationComplete)
+            sess.abort()
+        self._parseops = []
+        th = self._parsethread
+        if th:
+            self._parsethread = None
+            th.locksParsed.disconnect(self._onLocksParsed)
+            th.finished.disconnect(self._startParse)
+            if th.isRunning():
+                # lock files can't be parsed partially; let it finish alone
+                qtlib.detachThread(th)
+        s = self._settings
+        s.beginGroup('lock')
+        s.setValue('geom', self.saveGeometry())
+        s.setValue('treestate', self.locktw.header().saveState())
+        s.endGroup()
         QDialog.reject(self)
 
     @pyqtSlot()
@@ -180,7 +211,9 @@ class LockDialog(QDialog):
         sess = self._cmdsession
         self.refreshAction.setEnabled(sess.isFinished())
         self.addAction.setEnabled(sess.isFinished())
-        self.locktw.setEnabled(sess.isFinished())
+        if not sess.isFinished():
+            # enabled again by _onLocksParsed() once the list is up to date
+            self.locktw.setEnabled(False)
         self.stopAction.setEnabled(not sess.isFinished())
 
     @pyqtSlot()
@@ -188,13 +221,15 @@ class LockDialog(QDialog):
         # type: () -> None
         wfile, _filter = QFileDialog.getOpenFileName(
             self, _('Open a (nonmergable) file you wish to be locked'),
-            hglib.tounicode(self.repo.root), _FILE_FILTER)
+            hglib.tounicode(self.repo.root), _file_filter())
 
+        if not wfile:
+            return
         wfile = hglib.normpath(wfile)
-        pathprefix = hglib.tounicode(util.normpath(self.repo.root)) + '/'
-        if not os.path.normcase(wfile).startswith(os.path.normcase(pathprefix)):
+        if not os.path.normcase(wfile).startswith(self._rootprefix):
             self.showMessage.emit(_('File was not within current repository'))
-        wfile = wfile[len(pathprefix):]
+            return
+        wfile = wfile[len(self._rootprefix):]
 
         self.showMessage.emit(_('Locking %s') % wfile)
         self.lockrun(['lock', wfile])
@@ -213,38 +248,90 @@ class LockDialog(QDialog):
     def reload(self):
         # type: () -> None
         'update list of locks, then update UI'
+        if not self._cmdsession.isFinished():
+            # coalesce requests made while busy into a single reload
+            self._pendingreload = True
+            return
         self.showMessage.emit(_('Refreshing locks...'))
         self.lockrun(['locks']) # has side-effect of refreshing locks
 
     def lockrun(self, ucmdline):
         # type: (List[Text]) -> None
-        self.operation = ucmdline + [None]
+        self._op = ucmdline[0]
+        self._opfile = ucmdline[1] if len(ucmdline) > 1 else None
         self._cmdsession = sess = self._repoagent.runCommand(ucmdline, self)
         sess.commandFinished.connect(self.operationComplete)
         self._updateUi()
 
     def operationComplete(self):
         # type: () -> None
-        locks = self.refillModel()
         self._updateUi()
+        self._parseops.append((self._op, self._opfile))
+        self._op = 'N/A'
+        self._opfile = None
+        if not self._parsethread:
+            self.locktw.setEnabled(True)
+            return  # setup not finished
+        self._startParse()
 
-        op, wfile = self.operation[:2]
-        if op == 'lock':
-            if wfile in locks and locks[wfile][1]:
-                self.showMessage.emit(_('Lock of %s successful') % wfile)
-                qtlib.openlocalurl(wfile)
-            else:
-                self.showMessage.emit(_('Lock of %s failed, retry') % wfile)
-        elif op == 'unlock':
-            if wfile in locks and locks[wfile][1]:
-                self.showMessage.emit(_('Unlock of %s failed, retry') % wfile)
+    @pyqtSlot()
+    def _startParse(self):
+        # type: () -> None
+        'parse lock files for the finished operations, one parse at a time'
+        th = self._parsethread
+        # a running parse may have read the files before the operations;
+        # they are parsed again once it finishes
+        if not self._parseops or th.isRunning():
+            return
+        ops, self._parseops = self._parseops, []
+        th.parse(ops)
+
+    @pyqtSlot(object, object, object)
+    def _onLocksParsed(self, ops, locks, err):
+        # type: (List[Tuple[Text, Optional[Text]]], Dict[bytes, Sequence[bytes]], Optional[Exception]) -> None
+        if err:
+            self.showMessage.emit(hglib.tounicode(str(err)))
+        else:
+            self._showParsedLocks(ops, locks)
+        if not self._parseops:
+            # no newer parse to wait for
+            self.locktw.setEnabled(self._cmdsession.isFinished())
+        if self._pendingreload and self._cmdsession.isFinished():
+            self._pendingreload = False
+            self.reload()
+
+    def _showParsedLocks(self, ops, locks):
+        # type: (List[Tuple[Text, Optional[Text]]], Dict[bytes, Sequence[bytes]]) -> None
+        self.refillModel(locks)
+
+        reported = False
+        for op, wfile in ops:
+            if op not in ('lock', 'unlock') or wfile is None:
+                continue
+            # only the operated file is looked up, so convert just its name
+            row = self._model.rowForFile(hglib.fromunicode(wfile))
+            locked = row is not None and bool(self._model.rows[row][2])
+            if op == 'lock':
+                if locked:
+                    self.showMessage.emit(_('Lock of %s successful') % wfile)
+                    qtlib.openlocalurl(wfile)
+                else:
+                    self.showMessage.emit(_('Lock of %s failed, retry')
+                                          % wfile)
             else:
-                self.showMessage.emit(_('Unlock of %s successful') % wfile)
-        elif locks:
+                if locked:
+                    self.showMessage.emit(_('Unlock of %s failed, retry')
+                                          % wfile)
+                else:
+                    self.showMessage.emit(_('Unlock of %s successful')
+                                          % wfile)
+            reported = True
+        if reported:
+            return
+        if locks:
             self.showMessage.emit(_('Ready, double click to lock or unlock'))
         else:
             self.showMessage.emit(_('Ready'))
-        self.operation = ['N/A', None]
 
     @pyqtSlot()
     def stopclicked(self):
@@ -253,7 +340,7 @@ class LockDialog(QDialog):
     @pyqtSlot(QModelIndex)
     def rowDoubleClicked(self, index):
         # type: (QModelIndex) -> None
-        wfile, user, purpose = self.rawrows[index.row()]
+        wfile, user, purpose = self._model.rows[index.row()]
         curuser = hglib.fromunicode(qtlib.getCurrentUsername(self, self.repo))
         if user or purpose:
             if user != curuser:
@@ -275,3 +362,121 @@ class LockDialog(QDialog):
             sess.abort()
         else:
             return super(LockDialog, self).keyPressEvent(event)
+
+
+class ParseLocksThread(QThread):
+    '''Background thread for reading locked and lockable files'''
+
+    # (ops passed to parse(), locks, error); the result is passed with the
+    # signal so that restarting the thread can't clobber an undelivered one
+    locksParsed = pyqtSignal(object, object, object)
+
+    def __init__(self, sl, repo, parent=None):
+        super(ParseLocksThread, self).__init__(parent)
+        self._sl = sl
+        self.repo = hg.repository(repo.ui, repo.root)
+        self._ops = []  # type: List[Tuple[Text, Optional[Text]]]
+
+    def parse(self, ops):
+        # type: (List[Tuple[Text, Optional[Text]]]) -> None
+        'start parsing, on behalf of the given finished operations'
+        self._ops = ops
+        self.start()
+
+    def run(self):
+        ops = self._ops
+        locks = {}  # type: Dict[bytes, Sequence[bytes]]
+        err = None
+        try:
+            self.repo.invalidate()
+            # this code is specific to simplelock
+            locks = self._sl.parseLocks(self.repo)
+            lockables = self._sl.readlockables(self.repo)
+            # unlocked rows are only read, so they can share one value
+            empty = (b'', b'')
+            for wfile in lockables:
+                locks.setdefault(wfile, empty)
+            # this code is specific to simplelock
+        except (EnvironmentError, error.Abort) as e:
+            locks = {}
+            err = e
+        self.locksParsed.emit(ops, locks, err)
+
+
+class LockModel(QAbstractTableModel):
+    """Locked and lockable files; rows of (wfile, user, purpose) in bytes"""
+
+    def __init__(self, parent=None):
+        # type: (Optional[QWidget]) -> None
+        QAbstractTableModel.__init__(self, parent)
+        self.headers = (_('Path'), _('Locking User'), _('Purpose'))
+        self.rows = []  # type: List[Tuple[bytes, bytes, bytes]]
+        self._rowindex = {}  # type: Dict[bytes, int]
+
+    def setRows(self, rows):
+        # type: (List[Tuple[bytes, bytes, bytes]]) -> None
+        """Replace rows, notifying views of the changed rows only
+
+        Both the current and the new rows must be sorted by wfile, so that
+        selection and scroll position survive a reload.
+        """
+        if not self.rows:
+            self.beginResetModel()
+            self.rows = list(rows)
+            self._updateRowIndex()
+            self.endResetModel()
+            return
+
+        currows = self.rows
+        newfiles = set(r[0] for r in rows)
+        oldfiles = set(r[0] for r in currows)
+        for i in pycompat.xrange(len(currows) - 1, -1, -1):
+            if currows[i][0] not in newfiles:
+                self.beginRemoveRows(QModelIndex(), i, i)
+                del currows[i]
+                self.endRemoveRows()
+        # remaining rows are a sorted subset of the new rows
+        for i, row in enumerate(rows):
+            if row[0] not in oldfiles:
+                self.beginInsertRows(QModelIndex(), i, i)
+                currows.insert(i, row)
+                self.endInsertRows()
+            elif currows[i] != row:
+                currows[i] = row
+                self.dataChanged.emit(self.index(i, 1), self.index(i, 2))
+        self._updateRowIndex()
+
+    def _updateRowIndex(self):
+        # type: () -> None
+        self._rowindex = {r[0]: i for i, r in enumerate(self.rows)}
+
+    def rowForFile(self, wfile):
+        # type: (bytes) -> Optional[int]
+        """Row number of the given file, or None if not listed"""
+        return self._rowindex.get(wfile)
+
+    def rowCount(self, parent=QModelIndex()):
+        # type: (QModelIndex) -> int
+        if parent.isValid():
+            return 0 # no child
+        return len(self.rows)
+
+    def columnCount(self, parent=QModelIndex()):
+        # type: (QModelIndex) -> int
+        if parent.isValid():
+            return 0 # no child
+        return len(self.headers)
+
+    def data(self, index, role=Qt.DisplayRole):
+        # type: (QModelIndex, int) -> Optional[Text]
+        if not index.isValid():
+            return None
+        if role == Qt.DisplayRole:
+            return hglib.tounicode(self.rows[index.row()][index.column()])
+        return None
+
+    def headerData(self, col, orientation, role=Qt.DisplayRole):
+        # type: (int, int, int) -> Optional[Text]
+        if role != Qt.DisplayRole or orientation != Qt.Horizontal:
+            return None
+        return self.headers[col]
@@ -10,8 +10,10 @@
 
 from __future__ import absolute_import
 
+import collections
 import os
 import re
+from operator import itemgetter
 
 from .qtcore import (
     QAbstractItemModel,
@@ -51,6 +53,7 @@ if hglib.TYPE_CHECKING:
     from typing import (
         Any,
         Dict,
+        FrozenSet,
         List,
         Optional,
         Sequence,
@@ -84,6 +87,28 @@ _subrepoStatus2IcoMap = {
     'R': 'thg-removed-subrepo',
     }
 
+# file status without icon overlay
+_plainFileStatuses = frozenset(
+    [None] + [st for st, t in status.statusTypes.items() if not t.icon])
+
+# index of files of each status in the result of repo.status()
+_repoStatusIndexMap = {st: i for i, st in enumerate('MAR!?IC')}
+
+_statusOverlayCache = {}  # type: Dict[Text, Optional[QIcon]]
+
+def _statusOverlayIcon(st):
+    # type: (Text) -> Optional[QIcon]
+    """Icon to be overlaid on files of the given status, or None"""
+    try:
+        return _statusOverlayCache[st]
+    except KeyError:
+        name = status.statusTypes[st].icon
+        ic = None
+        if name:
+            ic = qtlib.geticon(name)
+        _statusOverlayCache[st] = ic
+        return ic
+
 class ManifestModel(QAbstractItemModel):
     """Status of files between two revisions or patch"""
 
@@ -103,13 +128,16 @@ class ManifestModel(QAbstractItemModel):
         QAbstractItemModel.__init__(self, parent)
 
         self._fileiconprovider = QFileIconProvider()
-        self._iconcache = {}  # (path, status, subkind): icon
+        self._iconcache = {}  # (status, subkind, isdir): icon
+        self._plainfileicon = None  # type: Optional[QIcon]
         self._repoagent = repoagent
 
         self._namefilter = pycompat.unicode(namefilter or '')
         assert all(c in 'MARSC' for c in statusfilter), repr(statusfilter)
         self._statusfilter = statusfilter
         self._changedfilesonly = False
+        # (ctx, pattern, changedonly, matcher) of the last population
+        self._matchercache = None  # type: Optional[Tuple[Any, bytes, bool, matchmod.basematcher]]
         self._nodeop = _nodeopmap[bool(flat)]
 
         self._rootentry = self._newRevNode(rev)
@@ -145,9 +173,7 @@ class ManifestModel(QAbstractItemModel):
             return filedata.createNullData(repo)
 
         f = index.internalPointer()  # type: "_Entry"
-        e = f.parent
-        while e and e.ctx is None:
-            e = e.parent
+        e = f.ctxroot
         assert e, 'root entry must have ctx'
         wfile = hglib.fromunicode(f.path[len(e.path):].lstrip('/'))
         rpath = hglib.fromunicode(e.path)
@@ -172,7 +198,13 @@ class ManifestModel(QAbstractItemModel):
         if not index.isValid():
             return QIcon()
         e = index.internalPointer()  # type: "_Entry"
-        k = (e.path, e.status, e.subkind)
+        if e.status in _plainFileStatuses and not e.isdir:
+            # most entries, e.g. clean files in manifest mode
+            ic = self._plainfileicon
+            if ic is None:
+                ic = self._plainfileicon = qtlib.geticon('text-x-generic')
+            return ic
+        k = (e.status, e.subkind, e.isdir)
         try:
             return self._iconcache[k]
         except KeyError:
@@ -198,9 +230,8 @@ class ManifestModel(QAbstractItemModel):
 
         if not e.status:
             return ic
-        st = status.statusTypes[e.status]
-        if st.icon:
-            icOverlay = qtlib.geticon(st.icon)
+        icOverlay = _statusOverlayIcon(e.status)
+        if icOverlay is not None:
             ic = qtlib.getoverlaidicon(ic, icOverlay)
 
         return ic
@@ -309,6 +340,11 @@ class ManifestModel(QAbstractItemModel):
         # type: (QModelIndex) -> int
         return len(self._parententry(parent))
 
+    def hasChildren(self, parent=QModelIndex()):
+        # type: (QModelIndex) -> bool
+        # don't populate collapsed directories just to draw the expand marker
+        return self._parententry(parent).haschild()
+
     def columnCount(self, parent=QModelIndex()):
         # type: (QModelIndex) -> int
         return 1
@@ -427,9 +463,10 @@ class ManifestModel(QAbstractItemModel):
 
     def canFetchMore(self, parent):
         # type: (QModelIndex) -> bool
-        if parent.isValid():
+        # polled by views all the time; answer the common case first
+        if self._rootpopulated:
             return False
-        return not self._rootpopulated
+        return not parent.isValid()
 
     def fetchMore(self, parent):
         # type: (QModelIndex) -> None
@@ -448,7 +485,7 @@ class ManifestModel(QAbstractItemModel):
         self.revLoaded.emit(self.rev())
 
     def _repopulateNodes(self, newnodeop=None, newroote=None):
-        # type: (Optional[Any], Optional["_Entry"]) -> None
+        # type: (Optional[_NodeOp], Optional["_Entry"]) -> None
         """Recreate populated nodes if any"""
         if not self._rootpopulated:
             # no stale nodes
@@ -468,11 +505,35 @@ class ManifestModel(QAbstractItemModel):
                 newroote = self._rootentry.copyskel()
             self._populateNodes(newroote)
             self._rootentry = newroote
-            for oi, path in oldindexmap:
-                self.changePersistentIndex(oi, self.indexFromPath(path))
+            self._remapPersistentIndexes(oldindexmap)
         finally:
             self.layoutChanged.emit()
 
+    def _remapPersistentIndexes(self, oldindexmap):
+        # type: (List[Tuple[QModelIndex, Text]]) -> None
+        """Move persistent indexes to the new entries of the same paths"""
+        roote = self._rootentry
+        flat = self.isFlat()
+        lastdir = None  # type: Optional[Text]
+        dire = roote  # type: Optional["_Entry"]
+        # sorted so that entries of the same directory are looked up at once
+        for oi, path in sorted(oldindexmap, key=itemgetter(1)):
+            if flat:
+                d, name = '', path
+            else:
+                d, _sep, name = path.rpartition('/')
+            if d != lastdir:
+                lastdir = d
+                try:
+                    dire = self._nodeop.findpath(roote, d) if d else roote
+                except KeyError:
+                    dire = None
+            if not name or dire is None or name not in dire:
+                self.changePersistentIndex(oi, QModelIndex())
+                continue
+            self.changePersistentIndex(
+                oi, self.createIndex(dire.index(name), 0, dire[name]))
+
     def _newRevNode(self, rev, prev=FirstParent):
         # type: (Optional[int], int) -> "_Entry"
         """Create empty root node for the specified revision"""
@@ -494,22 +555,38 @@ class ManifestModel(QAbstractItemModel):
     def _populateNodes(self, roote):
         # type: ("_Entry") -> None
         repo = self._repoagent.rawRepo()
+        ctx = roote.ctx
         lpat = hglib.fromunicode(self._namefilter)
-        match = _makematcher(repo, roote.ctx, lpat, self._changedfilesonly)
-        self._populate(roote, repo, self._nodeop, self._statusfilter, match)
+        changedonly = self._changedfilesonly
+        cached = self._matchercache
+        # status/flat filter changes can reuse the matcher of the same ctx
+        if (cached and cached[0] is ctx and cached[1] == lpat
+            and cached[2] == changedonly):
+            match = cached[3]
+        else:
+            match = _makematcher(repo, ctx, lpat, changedonly)
+            self._matchercache = (ctx, lpat, changedonly, match)
+        self._populate(roote, repo, self._nodeop,
+                       frozenset(self._statusfilter), match)
         roote.sort()
 
 
+# shared by entries without children; never modified
+_nochild = {}  # type: Dict[Text, "_Entry"]
+_nonames = []  # type: List[Text]
+
 class _Entry(object):
     """Each file or directory"""
 
-    __slots__ = ('_name', '_parent', 'status', 'ctx', 'pctx', 'subkind',
-                 '_child', '_nameindex')
+    __slots__ = ('_name', '_parent', '_path', 'status', 'ctx', 'pctx',
+                 'subkind', '_ctxroot', '_child', '_nameindex', '_namepos',
+                 '_pending')
 
     def __init__(self, name='', parent=None):
         # type: (Text, Optional["_Entry"]) -> None
         self._name = name
         self._parent = parent
+        self._path = None  # type: Optional[Text]
         self.status = None  # type: Optional[Text]
         # TODO: check this with newer pytype versions periodically.  It was fine
         #       when it was `Optional[context.basectx]`.
@@ -518,8 +595,15 @@ class _Entry(object):
         self.pctx = None  # type: Optional[ThgContext]
         # pytype: enable=not-supported-yet
         self.subkind = None  # type: Optional[Text]
-        self._child = {}  # type: Dict[Text, "_Entry"]
-        self._nameindex = []  # type: List[Text]
+        self._ctxroot = None  # type: Optional["_Entry"]
+        # leaves share the empty containers until a child is added
+        self._child = _nochild  # type: Dict[Text, "_Entry"]
+        # sorted names, built on demand after children are added
+        self._nameindex = _nonames  # type: Optional[List[Text]]
+        # built on demand by index(), so leaves never allocate it
+        self._namepos = None  # type: Optional[Dict[Text, int]]
+        # descendants not yet created: (relative path, status or entry)
+        self._pending = None  # type: Optional[List[Tuple[Text, Any]]]
 
     def copyskel(self):
         # type: () -> "_Entry"
@@ -539,23 +623,40 @@ class _Entry(object):
     @property
     def path(self):
         # type: () -> Text
-        if self.parent is None or not self.parent.name:
-            return self.name
-        else:
-            return self.parent.path + '/' + self.name
+        # cached on first access, which must not happen until the entry is
+        # attached to the tree
+        if self._path is None:
+            if self._parent is None or not self._parent._name:
+                self._path = self._name
+            else:
+                self._path = self._parent.path + '/' + self._name
+        return self._path
 
     @property
     def name(self):
         # type: () -> Text
         return self._name
 
+    @property
+    def ctxroot(self):
+        # type: () -> Optional["_Entry"]
+        """Nearest ancestor entry which has ctx"""
+        return self._ctxroot
+
     @property
     def isdir(self):
         # type: () -> bool
-        return bool(self.subkind or self._child)
+        return bool(self.subkind or self._child or self._pending)
+
+    def haschild(self):
+        # type: () -> bool
+        """Whether this entry has children, without creating them"""
+        return bool(self._child or self._pending)
 
     def __len__(self):
         # type: () -> int
+        if self._pending is not None:
+            self._materialize()
         return len(self._child)
 
     def __nonzero__(self):
@@ -567,44 +668,125 @@ class _Entry(object):
 
     def __getitem__(self, name):
         # type: (Text) -> "_Entry"
+        if self._pending is not None:
+            self._materialize()
         return self._child[name]
 
     def makechild(self, name):
         # type: (Text) -> "_Entry"
+        if self._pending is not None:
+            self._materialize()
         if name not in self._child:
-            self._nameindex.append(name)
+            self._addname(name)
         self._child[name] = e = self.__class__(name, parent=self)
+        e._ctxroot = self if self.ctx is not None else self._ctxroot
         return e
 
     def putchild(self, name, e):
         # type: (Text, "_Entry") -> None
         assert not e.name and not e.parent, (e.name, e.parent)
+        if self._pending is not None:
+            self._materialize()
         e._name = name
         e._parent = self
+        e._path = None
+        e._ctxroot = self if self.ctx is not None else self._ctxroot
         if name not in self._child:
-            self._nameindex.append(name)
+            self._addname(name)
         self._child[name] = e
 
+    def _addname(self, name):
+        # type: (Text) -> None
+        if self._child is _nochild:
+            self._child = {}
+        self._nameindex = None
+        self._namepos = None
+
+    def _names(self):
+        # type: () -> List[Text]
+        if self._nameindex is None:
+            self._sortchildren()
+        return self._nameindex
+
     def __contains__(self, item):
         # type: (Text) -> bool
+        if self._pending is not None:
+            self._materialize()
         return item in self._child
 
     def at(self, index):
         # type: (int) -> "_Entry"
-        return self._child[self._nameindex[index]]
+        if self._pending is not None:
+            self._materialize()
+        return self._child[self._names()[index]]
 
     def index(self, name):
         # type: (Text) -> int
-        return self._nameindex.index(name)
+        if self._pending is not None:
+            self._materialize()
+        pos = self._namepos
+        if pos is None:
+            pos = self._namepos = {n: i for i, n in enumerate(self._names())}
+        return pos[name]
+
+    def addpending(self, path, item):
+        # type: (Text, Any) -> None
+        """Queue descendant at the relative path to be created on demand
+
+        item is either the status of the file or the entry to be put.
+        """
+        if self._pending is None:
+            self._pending = []
+        self._pending.append((path, item))
+
+    def _materialize(self):
+        # type: () -> None
+        """Create the immediate children from the pending paths"""
+        pending = self._pending
+        self._pending = None
+        if self._child is _nochild:
+            self._child = {}
+        getchild = self._child.get
+        makechild = self.makechild
+        entrytype = _Entry
+        for path, item in pending:
+            i = path.find('/')
+            if i >= 0:
+                name = path[:i]
+                e = getchild(name)
+                if e is None:
+                    e = makechild(name)
+                e.addpending(path[i + 1:], item)
+            elif isinstance(item, entrytype):
+                self.putchild(path, item)
+            else:
+                e = getchild(path)
+                if e is None:
+                    e = makechild(path)
+                e.status = item
 
     def sort(self, reverse=False):
         # type: (bool) -> None
-        """Sort the entries recursively; directories first"""
+        """Sort the entries recursively; directories first
+
+        Entries not created yet will be sorted when they are.
+        """
+        if self._pending is not None:
+            return
         for e in self._child.values():
-            e.sort(reverse=reverse)
-        self._nameindex.sort(
-            key=lambda s: (not self[s].isdir, os.path.normcase(s)),
+            # no need to descend into leaves, e.g. all entries in flat mode
+            if e._child or e._pending:
+                e.sort(reverse=reverse)
+        self._sortchildren(reverse)
+
+    def _sortchildren(self, reverse=False):
+        # type: (bool) -> None
+        child = self._child
+        normcase = os.path.normcase
+        self._nameindex = sorted(
+            child, key=lambda s: (not child[s].isdir, normcase(s)),
             reverse=reverse)
+        self._namepos = None
 
 
 def _isreporev(rev):
@@ -627,6 +809,11 @@ def _makematcher(repo, ctx, pat, changedonly):
     patterns = []
     if pat and b':' not in pat and b'*' not in pat:
         # mimic case-insensitive partial string match
+        if not changedonly:
+            # a plain regex search is much cheaper to set up than a pattern
+            # matcher per keystroke
+            rx = re.compile(re.escape(pat), re.IGNORECASE)
+            return matchmod.predicatematcher(rx.search, predrepr=pat)
         patterns.append(b'relre:(?i)' + re.escape(pat))
     elif pat:
         patterns.append(pat)
@@ -646,50 +833,39 @@ def _makematcher(repo, ctx, pat, changedonly):
         return scmutil.matchfiles(repo, [])  # TODO: use matchmod.never()
 
 
-class _listnodeop(object):
-    subreporecursive = False
+_NodeOp = collections.namedtuple(
+    '_NodeOp', ['findpath', 'putstatus', 'putpath', 'subreporecursive'])
 
-    @staticmethod
-    def findpath(e, path):
-        # type: (_Entry, Text) -> _Entry
-        return e[path]
+def _listfindpath(e, path):
+    # type: (_Entry, Text) -> _Entry
+    return e[path]
 
-    @staticmethod
-    def makepath(e, path):
-        # type: (_Entry, Text) -> _Entry
-        return e.makechild(path)
+def _listputstatus(e, path, st):
+    # type: (_Entry, Text, Text) -> None
+    e.makechild(path).status = st
 
-    @staticmethod
-    def putpath(e, path, c):
-        # type: (_Entry, Text, _Entry) -> None
-        e.putchild(path, c)
+def _listputpath(e, path, c):
+    # type: (_Entry, Text, _Entry) -> None
+    e.putchild(path, c)
 
-class _treenodeop(object):
-    subreporecursive = True
+def _treefindpath(e, path):
+    # type: (_Entry, Text) -> _Entry
+    for p in path.split('/'):
+        e = e[p]
+    return e
 
-    @staticmethod
-    def findpath(e, path):
-        # type: (_Entry, Text) -> _Entry
-        for p in path.split('/'):
-            e = e[p]
-        return e
+# directories are filled when first accessed
 
-    @staticmethod
-    def makepath(e, path):
-        # type: (_Entry, Text) -> _Entry
-        for p in path.split('/'):
-            if p not in e:
-                e.makechild(p)
-            e = e[p]
-        return e
+def _treeputstatus(e, path, st):
+    # type: (_Entry, Text, Text) -> None
+    e.addpending(path, st)
+
+def _treeputpath(e, path, c):
+    # type: (_Entry, Text, _Entry) -> None
+    e.addpending(path, c)
 
-    @staticmethod
-    def putpath(e, path, c):
-        # type: (_Entry, Text, _Entry) -> None
-        rp = path.rfind('/')
-        if rp >= 0:
-            e = _treenodeop.makepath(e, path[:rp])
-        e.putchild(path[rp + 1:], c)
+_listnodeop = _NodeOp(_listfindpath, _listputstatus, _listputpath, False)
+_treenodeop = _NodeOp(_treefindpath, _treeputstatus, _treeputpath, True)
 
 _nodeopmap = {
     False: _treenodeop,
@@ -698,8 +874,7 @@ _nodeopmap = {
 
 
 def _populaterepo(roote, repo, nodeop, statusfilter, match):
-    # type: (_Entry, localrepo.localrepository, Any, Text, matchmod.basematcher) -> None
-    # TODO: replace 'Any' with structural typing for _treenodeop/_listnodeop
+    # type: (_Entry, localrepo.localrepository, _NodeOp, FrozenSet[Text], matchmod.basematcher) -> None
     if 'S' in statusfilter:
         _populatesubrepos(roote, repo, nodeop, statusfilter, match)
 
@@ -709,12 +884,14 @@ def _populaterepo(roote, repo, nodeop, statusfilter, match):
     with lfutil.lfstatus(repo):
         stat = repo.status(pctx, ctx, match, clean='C' in statusfilter)
 
-    for st, files in zip('MAR!?IC', stat):
-        if st not in statusfilter:
-            continue
-        for path in files:
-            e = nodeop.makepath(roote, hglib.tounicode(path))
-            e.status = st
+    putstatus = nodeop.putstatus
+    tounicode = hglib.tounicode
+    for st in statusfilter:
+        i = _repoStatusIndexMap.get(st)
+        if i is None:
+            continue  # 'S'
+        for path in stat[i]:
+            putstatus(roote, tounicode(path), st)
 
 def _comparesubstate(state1, state2):
     # type: (Tuple[bytes, bytes, bytes], Tuple[bytes, bytes, bytes]) -> Text
@@ -728,15 +905,17 @@ def _comparesubstate(state1, state2):
         return 'M'
 
 def _populatesubrepos(roote, repo, nodeop, statusfilter, match):
-    # type: (_Entry, localrepo.localrepository, Any, Text, matchmod.basematcher) -> None
-    # TODO: replace 'Any' with structural typing for _treenodeop/_listnodeop
+    # type: (_Entry, localrepo.localrepository, _NodeOp, FrozenSet[Text], matchmod.basematcher) -> None
     ctx = roote.ctx
     pctx = roote.pctx
+    getsubstate = ctx.substate.get
+    getpsubstate = pctx.substate.get
+    nullstate = hglib.nullsubrepostate
     subpaths = set(pctx.substate)
     subpaths.update(ctx.substate)
     for path in subpaths:
-        substate = ctx.substate.get(path, hglib.nullsubrepostate)
-        psubstate = pctx.substate.get(path, hglib.nullsubrepostate)
+        substate = getsubstate(path, nullstate)
+        psubstate = getpsubstate(path, nullstate)
         e = _Entry()
         e.status = _comparesubstate(psubstate, substate)
         if e.status == 'R':
@@ -766,22 +945,21 @@ def _populatesubrepos(roote, repo, nodeop, statusfilter, match):
 
         # subrepo is filtered out only if the node and its children do not
         # match the specified condition at all
-        if len(e) > 0 or (e.status in statusfilter and match(path)):
+        if e.haschild() or (e.status in statusfilter and match(path)):
             nodeop.putpath(roote, hglib.tounicode(path), e)
 
 def _populatepatch(roote, repo, nodeop, statusfilter, match):
-    # type: (_Entry, localrepo.localrepository, Any, Text, matchmod.basematcher) -> None
-    # TODO: replace 'Any' with structural typing for _treenodeop/_listnodeop
+    # type: (_Entry, localrepo.localrepository, _NodeOp, FrozenSet[Text], matchmod.basematcher) -> None
     ctx = roote.ctx
     stat = ctx.changesToParent(0)  # pytype: disable=attribute-error
+    putstatus = nodeop.putstatus
+    tounicode = hglib.tounicode
     for st, files in zip('MAR', stat):
         if st not in statusfilter:
             continue
         for path in files:
-            if not match(path):
-                continue
-            e = nodeop.makepath(roote, hglib.tounicode(path))
-            e.status = st
+            if match(path):
+                putstatus(roote, tounicode(path), st)
 
 
 class ManifestCompleter(QCompleter):
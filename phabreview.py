@@ -12,10 +12,13 @@ from mercurial import (
 )
 
 from .qtcore import (
+    QAbstractListModel,
     QBuffer,
     QIODevice,
+    QModelIndex,
     QSettings,
     QSortFilterProxyModel,
+    QTimer,
     Qt,
     pyqtSlot,
 )
@@ -24,8 +27,6 @@ from .qtgui import (
     QKeySequence,
     QListWidgetItem,
     QShortcut,
-    QStandardItem,
-    QStandardItemModel,
 )
 
 from ..util import hglib
@@ -44,15 +45,20 @@ if hglib.TYPE_CHECKING:
     from typing import (
         Any,
         Dict,
+        Iterable,
         List,
         Optional,
         Sequence,
         Text,
+        Tuple,
     )
     from mercurial import (
         localrepo,
         ui as uimod,
     )
+    from .qtcore import (
+        QObject,
+    )
     from .qtgui import (
         QWidget,
     )
@@ -68,7 +74,9 @@ class user(tuple):
 
     def __new__(cls, username, realname, roles):
         # type: (Any, Text, Text, List[Text]) -> user
-        return tuple.__new__(cls, (username, realname, roles))
+        # the display text is shown for every row, so format it only once
+        display = '%s (%s)' % (realname, username)
+        return tuple.__new__(cls, (username, realname, roles, display))
 
     @property
     def username(self):
@@ -88,9 +96,88 @@ class user(tuple):
         '''the roles filled by this user'''
         return self[2]
 
+    @property
+    def display(self):
+        # type: () -> Text
+        '''text to show this user in lists'''
+        return self[3]
+
     def __repr__(self):
         # type: () -> Text
-        return '%s (%s)' % (self.realname, self.username)
+        return self[3]
+
+
+# parameters of user.search conduit call; %s is replaced by extra parameters
+_USER_SEARCH_FMT = b'{"constraints":{"isBot":false,"isDisabled":false}%s}'
+
+def _reviewerhistorypaths(url, callsign):
+    # type: (Optional[bytes], Optional[bytes]) -> Dict[bool, Optional[Text]]
+    """Settings paths of the server-wide and per-repository reviewer history,
+    keyed by whether the path includes the callsign"""
+    if not url:
+        return {False: None, True: None}
+
+    scheme, hostpath = url.split(b'://', 1)
+    if hostpath.endswith(b'/'):
+        hostpath = hostpath[0:-1]
+
+    paths = {False: 'phabsend/%s/reviewers' % hostpath,
+             True: None}  # type: Dict[bool, Optional[Text]]
+    if callsign:
+        paths[True] = 'phabsend/%s/%s/reviewers' % (hostpath, callsign)
+    return paths
+
+
+class _ReviewersModel(QAbstractListModel):
+    """List of users who can be selected as reviewers"""
+
+    UserRole = Qt.UserRole + 1
+    FilterRole = Qt.UserRole + 2  # lower-cased display text
+
+    def __init__(self, parent=None):
+        # type: (Optional[QObject]) -> None
+        super(_ReviewersModel, self).__init__(parent)
+        self._users = []  # type: List[user]
+        self._filterkeys = []  # type: List[Text]
+
+    def rowCount(self, parent=QModelIndex()):
+        # type: (QModelIndex) -> int
+        if parent.isValid():
+            return 0  # no child
+        return len(self._users)
+
+    def data(self, index, role=Qt.DisplayRole):
+        # type: (QModelIndex, int) -> Any
+        if not index.isValid():
+            return None
+        if role == Qt.DisplayRole:
+            return self._users[index.row()].display
+        if role == self.UserRole:
+            return self._users[index.row()]
+        if role == self.FilterRole:
+            return self._filterkeys[index.row()]
+        return None
+
+    def reviewer(self, row):
+        # type: (int) -> user
+        return self._users[row]
+
+    def appendReviewers(self, users):
+        # type: (List[user]) -> None
+        if not users:
+            return
+        first = len(self._users)
+        self.beginInsertRows(QModelIndex(), first, first + len(users) - 1)
+        self._users.extend(users)
+        self._filterkeys.extend(u.display.lower() for u in users)
+        self.endInsertRows()
+
+    def clear(self):
+        # type: () -> None
+        self.beginResetModel()
+        del self._users[:]
+        del self._filterkeys[:]
+        self.endResetModel()
 
 
 class PhabReviewDialog(QDialog):
@@ -109,14 +196,24 @@ class PhabReviewDialog(QDialog):
         self._rescansession = cmdcore.nullCmdSession()
         self._namesession = cmdcore.nullCmdSession()
         self._my_username = None
+        self._settings = QSettings()
+        # users in the selected reviewers list, keyed by username
+        self._selectedreviewers = {}  # type: Dict[Text, user]
+        # the same users in the order the list widget shows them
+        self._selectedreviewerorder = []  # type: List[user]
+        # (revs, exported patches) of the last preview export
+        self._exportcache = None  # type: Optional[Tuple[Tuple[int, ...], Text]]
+        self._exportrevs = ()  # type: Tuple[int, ...]
 
         self._qui = Ui_PhabReviewDialog()
         self._qui.setupUi(self)
 
         proxymodel = QSortFilterProxyModel(self._qui.available_reviewer_list)
         proxymodel.setDynamicSortFilter(True)
-        proxymodel.setSourceModel(QStandardItemModel())
-        proxymodel.setFilterCaseSensitivity(Qt.CaseInsensitive)
+        proxymodel.setSourceModel(_ReviewersModel(proxymodel))
+        # match against pre-folded text instead of folding every row per key
+        proxymodel.setFilterRole(_ReviewersModel.FilterRole)
+        proxymodel.setFilterCaseSensitivity(Qt.CaseSensitive)
         proxymodel.sort(0)
         self.availablereviewersmodel = proxymodel
 
@@ -125,8 +222,14 @@ class PhabReviewDialog(QDialog):
         reviewerlist.selectionModel().selectionChanged.connect(
             self.on_available_reviewer_selection_changed)
 
+        # coalesce fast typing into a single filter pass
+        self._filterlater = timer = QTimer(self)
+        timer.setInterval(100)
+        timer.setSingleShot(True)
+        timer.timeout.connect(self._filterreviewers)
+
         reviewerfilter = self._qui.reviewer_filter
-        reviewerfilter.textChanged.connect(proxymodel.setFilterFixedString)
+        reviewerfilter.textChanged.connect(self._filterlater.start)
 
         selectedreviewerlist = self._qui.selected_reviewers_list
         selectedreviewerlist.selectionModel().selectionChanged.connect(
@@ -147,6 +250,8 @@ class PhabReviewDialog(QDialog):
 
             self.setWindowTitle(title)
 
+        self._historypaths = _reviewerhistorypaths(url, callsign)
+
         self._initchangesets(revs)
         self._initpreviewtab()
         self._readreviewerhistory()
@@ -161,12 +266,12 @@ class PhabReviewDialog(QDialog):
 
     def _readsettings(self):
         # type: () -> None
-        s = QSettings()
+        s = self._settings
         self.restoreGeometry(qtlib.readByteArray(s, 'phabsend/geom'))
 
     def _writesettings(self):
         # type: () -> None
-        s = QSettings()
+        s = self._settings
         s.setValue('phabsend/geom', self.saveGeometry())
 
     def _reviewerhistorypath(self, withcallsign=False):
@@ -176,23 +281,7 @@ class PhabReviewDialog(QDialog):
         If no reviewers are stored or the configuration isn't present to find
         the reviewers, no path is returned.
         '''
-        url = self._ui.config(b'phabricator', b'url')
-        if not url:
-            return None
-
-        scheme, hostpath = url.split(b'://', 1)
-        if hostpath.endswith(b'/'):
-            hostpath = hostpath[0:-1]
-
-        if not withcallsign:
-            return 'phabsend/%s/reviewers' % hostpath
-
-        callsign = self._ui.config(b'phabricator', b'callsign')
-
-        if not callsign:
-            return None
-
-        return 'phabsend/%s/%s/reviewers' % (hostpath, callsign)
+        return self._historypaths[withcallsign]
 
     def _getreviewerhistory(self):
         # type: () -> List[user]
@@ -203,7 +292,7 @@ class PhabReviewDialog(QDialog):
         if not path:
             return []
 
-        s = QSettings()
+        s = self._settings
 
         reviewers = []
 
@@ -230,30 +319,76 @@ class PhabReviewDialog(QDialog):
         '''
         availablereviewers = self.availablereviewersmodel.sourceModel()
 
-        history = {r.username: r for r in self._getreviewerhistory()}
-        for reviewer in history.values():
-            item = QStandardItem(pycompat.unicode(reviewer))
-            item.setData(reviewer)
+        # keep the stored order rather than depending on dict ordering
+        history = {}  # type: Dict[Text, user]
+        users = []
+        for r in self._getreviewerhistory():
+            if r.username not in history:
+                history[r.username] = r
+                users.append(r)
 
-            # Must add to source model since setDynamicSortFilter() is True.
-            availablereviewers.appendRow(item)
+        # Must add to source model since setDynamicSortFilter() is True.
+        # All rows are inserted at once so the proxy maps them in one pass.
+        availablereviewers.appendReviewers(users)
 
         # Preselect the last set of reviewers for this repository, if known.
+        self._addselectedreviewers(history.get(username)
+                                   for username in self._getlastreviewers())
+
+    def _addselectedreviewers(self, users):
+        # type: (Iterable[Optional[user]]) -> None
+        '''Appends the given users to the selected reviewers list, skipping
+        unknown and already selected ones'''
+        reviewers = self._qui.selected_reviewers_list
+        # sort and repaint once after the batch, not on every insertion
+        reviewers.setUpdatesEnabled(False)
+        reviewers.setSortingEnabled(False)
+        try:
+            for reviewer in users:
+                if not reviewer or reviewer.username in self._selectedreviewers:
+                    continue
+                self._selectedreviewers[reviewer.username] = reviewer
+                witem = QListWidgetItem(reviewer.display)
+                witem.setData(Qt.UserRole + 1, reviewer)
+                reviewers.addItem(witem)
+        finally:
+            reviewers.setSortingEnabled(True)
+            reviewers.sortItems()
+            reviewers.setUpdatesEnabled(True)
+        self._updateselectedorder()
+
+    def _updateselectedorder(self):
+        # type: () -> None
+        '''Re-reads the selected reviewers from the widget rows, which are
+        sorted by the widget itself'''
+        reviewers = self._qui.selected_reviewers_list
+        self._selectedreviewerorder = [
+            reviewers.item(i).data(Qt.UserRole + 1)
+            for i in pycompat.xrange(reviewers.count())]
+
+    def _selectedreviewerlist(self):
+        # type: () -> List[user]
+        '''Returns the selected reviewers in the order they are listed'''
+        return list(self._selectedreviewerorder)
+
+    def _getlastreviewers(self):
+        # type: () -> List[Text]
+        '''Returns the usernames selected for the previous review on this
+        repository, as identified by the callsign.
+        '''
         path = self._reviewerhistorypath(withcallsign=True)
-        if path:
-            s = QSettings()
-            reviewers = self._qui.selected_reviewers_list
-            size = s.beginReadArray(path)
-
-            for idx in pycompat.xrange(size):
-                s.setArrayIndex(idx)
-                username = qtlib.readString(s, "username")
-                reviewer = history.get(username)
-                if reviewer:
-                    witem = QListWidgetItem(pycompat.unicode(reviewer))
-                    witem.setData(Qt.UserRole + 1, reviewer)
-                    reviewers.addItem(witem)
-            s.endArray()
+        if not path:
+            return []
+
+        s = self._settings
+        usernames = []
+        size = s.beginReadArray(path)
+        for idx in pycompat.xrange(size):
+            s.setArrayIndex(idx)
+            usernames.append(qtlib.readString(s, "username"))
+        s.endArray()
+
+        return usernames
 
     def _writereviewerhistory(self):
         # type: () -> None
@@ -269,35 +404,37 @@ class PhabReviewDialog(QDialog):
         if not path:
             return
 
+        history = self._getreviewerhistory()
         # Avoid set() when eliminating duplicates, which hashes the role list
-        reviewers = {r.username: r for r in self._getreviewerhistory()}
-        selectedreviewers = self._qui.selected_reviewers_list
+        reviewers = {r.username: r for r in history}
+        selected = self._selectedreviewerlist()
 
-        for i in pycompat.xrange(selectedreviewers.count()):
-            reviewer = selectedreviewers.item(i).data(Qt.UserRole + 1)
+        for reviewer in selected:
             reviewers[reviewer.username] = reviewer
 
-        s = QSettings()
-        s.beginWriteArray(path)
+        s = self._settings
 
-        for i, reviewer in enumerate(reviewers.values()):
-            s.setArrayIndex(i)
-            s.setValue("username", reviewer.username)
-            s.setValue("realname", reviewer.realname)
-            s.setValue("roles", reviewer.roles)
+        # Nothing to store if all selected reviewers are known as is
+        if list(reviewers.values()) != history:
+            s.beginWriteArray(path)
 
-        s.endArray()
+            for i, reviewer in enumerate(reviewers.values()):
+                s.setArrayIndex(i)
+                s.setValue("username", reviewer.username)
+                s.setValue("realname", reviewer.realname)
+                s.setValue("roles", reviewer.roles)
+
+            s.endArray()
 
         # Store the currently selected reviewers, if tied to a repo.
         path = self._reviewerhistorypath(withcallsign=True)
-        if path:
-            reviewers = self._qui.selected_reviewers_list
+        usernames = [r.username for r in selected]
+        if path and usernames != self._getlastreviewers():
             s.beginWriteArray(path)
 
-            for i in pycompat.xrange(reviewers.count()):
+            for i, username in enumerate(usernames):
                 s.setArrayIndex(i)
-                s.setValue("username",
-                           reviewers.item(i).data(Qt.UserRole + 1).username)
+                s.setValue("username", username)
             s.endArray()
 
     def _initchangesets(self, revs):
@@ -312,6 +449,7 @@ class PhabReviewDialog(QDialog):
                                             selectedrevs=revs,
                                             parent=self)
         self._changesets.dataChanged.connect(self._updateforms)
+        self._changesets.dataChanged.connect(self._clearexportcache)
         self._qui.changesets_view.setModel(self._changesets)
 
     @property
@@ -335,9 +473,7 @@ class PhabReviewDialog(QDialog):
         """Generate opts for phabsend by form values"""
         opts['rev'] = hglib.compactrevs(self._revs)
 
-        reviewerlist = self._qui.selected_reviewers_list
-        opts['reviewer'] = [reviewerlist.item(i).data(Qt.UserRole + 1).username
-                            for i in pycompat.xrange(reviewerlist.count())]
+        opts['reviewer'] = [r.username for r in self._selectedreviewerlist()]
 
         return opts
 
@@ -384,6 +520,7 @@ class PhabReviewDialog(QDialog):
         initqsci(self._qui.preview_edit)
 
         self._qui.main_tabs.currentChanged.connect(self._refreshpreviewtab)
+        self._repoagent.repositoryChanged.connect(self._clearexportcache)
         self._refreshpreviewtab(self._qui.main_tabs.currentIndex())
 
     def forwardFont(self, font):
@@ -397,19 +534,36 @@ class PhabReviewDialog(QDialog):
         if self._previewtabindex() != index:
             return
 
+        revs = tuple(self._revs)
+        if self._exportcache and self._exportcache[0] == revs:
+            self._setpreviewtext(self._exportcache[1])
+            return
+
         self._qui.preview_edit.clear()
 
         cmdline = hglib.buildcmdargs('export', git=True,
-                                     rev=hglib.compactrevs(self._revs))
+                                     rev=hglib.compactrevs(revs))
+        self._exportrevs = revs
         self._cmdsession = sess = self._repoagent.runCommand(cmdline)
         sess.setCaptureOutput(True)
         sess.commandFinished.connect(self._updatepreview)
 
+    @pyqtSlot()
+    def _clearexportcache(self):
+        # type: () -> None
+        self._exportcache = None
+
     @pyqtSlot()
     def _updatepreview(self):
         # type: () -> None
-        preview = self._qui.preview_edit
         exported = hglib.tounicode(bytes(self._cmdsession.readAll()))
+        if self._cmdsession.exitCode() == 0:
+            self._exportcache = (self._exportrevs, exported)
+        self._setpreviewtext(exported)
+
+    def _setpreviewtext(self, exported):
+        # type: (Text) -> None
+        preview = self._qui.preview_edit
 
         callsign = self._ui.config(b'phabricator', b'callsign')
         if not callsign:
@@ -418,22 +572,20 @@ class PhabReviewDialog(QDialog):
         if not url:
             url = b'Not Configured!'
 
-        reviewerlist = self._qui.selected_reviewers_list
-        role = Qt.UserRole + 1
-
-        reviewers = [reviewerlist.item(i).data(role).username
-                     for i in pycompat.xrange(reviewerlist.count())]
+        reviewers = [r.username for r in self._selectedreviewerlist()]
         if reviewers:
             reviewers = u', '.join(reviewers)
         else:
             reviewers = u'None'
 
-        preview.append(u'Server:    %s\n' % hglib.tounicode(url))
-        preview.append(u'Callsign:  %s\n' % hglib.tounicode(callsign))
-        preview.append(u'Reviewers: %s\n' % reviewers)
-        preview.append(u'\n\n')
-
-        preview.append(exported)
+        # set at once so the diff lexer styles the text in a single pass
+        preview.setText(u''.join([
+            u'Server:    %s\n' % hglib.tounicode(url),
+            u'Callsign:  %s\n' % hglib.tounicode(callsign),
+            u'Reviewers: %s\n' % reviewers,
+            u'\n\n',
+            exported,
+        ]))
 
     def _previewtabindex(self):
         # type: () -> None
@@ -473,6 +625,7 @@ class PhabReviewDialog(QDialog):
         #
         # Additional roles include "list" for mailing list entries.
 
+        users = []
         for data in conduitresult.get('data', {}):
             fields = data.get('fields', {})
             realname = fields.get('realName')
@@ -485,12 +638,11 @@ class PhabReviewDialog(QDialog):
                 continue
 
             # https://github.com/google/pytype/issues/500
-            u = user(username, realname, roles)  # pytype: disable=wrong-arg-count
-            item = QStandardItem(pycompat.unicode(u))
-            item.setData(u)
+            users.append(user(username, realname, roles))  # pytype: disable=wrong-arg-count
 
-            # Must add to source model since setDynamicSortFilter() is True.
-            availablereviewers.appendRow(item)
+        # Must add to source model since setDynamicSortFilter() is True.
+        # All rows are inserted at once so the proxy maps them in one pass.
+        availablereviewers.appendReviewers(users)
 
     def _queryreviewers(self, after):
         # type: (Optional[bytes]) -> None
@@ -504,21 +656,10 @@ class PhabReviewDialog(QDialog):
         # phabsend doesn't seem to complain about sending reviews to deactivate
         # users, but filter them out anyway.  It also doesn't seem to make much
         # sense to send a review request to a bot.
+        params = b''
         if after is not None:
-            buf.setData(b'''{
-                "constraints": {
-                    "isBot": false,
-                    "isDisabled": false
-                },
-                "after": %s
-            }''' % after)
-        else:
-            buf.setData(b'''{
-                "constraints": {
-                    "isBot": false,
-                    "isDisabled": false
-                }
-            }''')
+            params = b',"after":' + after
+        buf.setData(_USER_SEARCH_FMT % params)
 
         buf.open(QIODevice.ReadOnly)
 
@@ -598,6 +739,12 @@ class PhabReviewDialog(QDialog):
         # Done, either by error or completing the sequence.
         self._qui.rescan_button.setEnabled(True)
 
+    @pyqtSlot()
+    def _filterreviewers(self):
+        # type: () -> None
+        text = self._qui.reviewer_filter.text()
+        self.availablereviewersmodel.setFilterFixedString(text.lower())
+
     @pyqtSlot()
     def on_available_reviewer_selection_changed(self):
         # type: () -> None
@@ -615,16 +762,11 @@ class PhabReviewDialog(QDialog):
         # type: () -> None
         """Populates the selected reviewers list when the ">" button is clicked.
         """
-        reviewers = self._qui.selected_reviewers_list
         proxymodel = self.availablereviewersmodel
         model = proxymodel.sourceModel()
-
-        for i in self._qui.available_reviewer_list.selectedIndexes():
-            item = model.item(proxymodel.mapToSource(i).row())
-            if not reviewers.findItems(item.text(), Qt.MatchExactly):
-                witem = QListWidgetItem(item.text())
-                witem.setData(Qt.UserRole + 1, item.data())
-                reviewers.addItem(witem)
+        self._addselectedreviewers(
+            model.reviewer(proxymodel.mapToSource(i).row())
+            for i in self._qui.available_reviewer_list.selectedIndexes())
 
     @pyqtSlot()
     def on_removereviewer_button_clicked(self):
@@ -634,7 +776,9 @@ class PhabReviewDialog(QDialog):
         """
         reviewers = self._qui.selected_reviewers_list
         for i in reviewers.selectedItems():
+            del self._selectedreviewers[i.data(Qt.UserRole + 1).username]
             reviewers.takeItem(reviewers.row(i))
+        self._updateselectedorder()
 
     @pyqtSlot()
     def on_selectall_button_clicked(self):
@@ -27,11 +27,10 @@ from .qtcore import (
     pyqtSlot,
 )
 from .qtgui import (
+    QAction,
     QDesktopServices,
     QDialog,
-    QKeySequence,
     QLineEdit,
-    QShortcut,
 )
 
 from mercurial import (
@@ -46,11 +45,10 @@ from . import (
     cmdcore,
     qtlib,
 )
-from .hgemail import _ChangesetsModel
-from .postreview_ui import Ui_PostReviewDialog
 
 if hglib.TYPE_CHECKING:
     from typing import (
+        Any,
         Dict,
         List,
         Optional,
@@ -70,11 +68,24 @@ if hglib.TYPE_CHECKING:
     )
 
 
+def _lastfield(output, sep):
+    # type: (bytearray, bytes) -> bytes
+    """Stripped text after the last occurrence of sep, or the whole output
+    if there is none"""
+    pos = output.rfind(sep)
+    if pos >= 0:
+        output = output[pos + len(sep):]
+    return bytes(output.strip())
+
+
 class LoadReviewDataThread(QThread):
     def __init__ (self, dialog):
         # type: ("PostReviewDialog") -> None
         super(LoadReviewDataThread, self).__init__(dialog)
         self.dialog = dialog
+        # filled by run(), to be read once the thread has finished
+        self.repositories = []
+        self.pendingrequests = []
 
     def run(self):
         # type: () -> None
@@ -93,10 +104,10 @@ class LoadReviewDataThread(QThread):
                 if not pwd:
                     pwd = b"None"
 
-                self.reviewboard = rb.make_rbclient(self.dialog.server,
-                                                    self.dialog.user,
-                                                    pwd)
-                self.loadCombos()
+                client = rb.make_rbclient(self.dialog.server,
+                                          self.dialog.user,
+                                          pwd)
+                self.loadReviewData(client)
 
             except rb.ReviewBoardError as e:
                 msg = e.msg
@@ -108,29 +119,19 @@ class LoadReviewDataThread(QThread):
 
         self.dialog.error_message = msg
 
-    def loadCombos(self):
-        # type: () -> None
-        #Get the index of a users previously selected repo id
-        index = 0
-        count = 0
-
-        self.dialog.qui.progress_label.setText("Loading repositories...")
-        for r in self.reviewboard.repositories():
-            if r.id == self.dialog.repo_id:
-                index = count
-            self.dialog.qui.repo_id_combo.addItem(str(r.id) + ": " + r.name)
-            count += 1
-
-        if self.dialog.qui.repo_id_combo.count():
-            self.dialog.qui.repo_id_combo.setCurrentIndex(index)
-
-        self.dialog.qui.progress_label.setText("Loading existing reviews...")
-        for r in self.reviewboard.pending_user_requests():
-            summary = str(r.id) + ": " + r.summary[0:100]
-            self.dialog.qui.review_id_combo.addItem(summary)
+    def loadReviewData(self, client):
+        # type: (Any) -> None
+        # one after another, as the client's session isn't known to be
+        # safe to share between threads
+        repositories = list(client.repositories())
+        if self.isInterruptionRequested():
+            return
+        pending = list(client.pending_user_requests())
+        if self.isInterruptionRequested():
+            return
 
-        if self.dialog.qui.review_id_combo.count():
-            self.dialog.qui.review_id_combo.setCurrentIndex(0)
+        self.repositories = repositories
+        self.pendingrequests = pending
 
 class PostReviewDialog(QDialog):
     """Dialog for sending patches to reviewboard"""
@@ -141,20 +142,34 @@ class PostReviewDialog(QDialog):
         self.ui = ui
         self._repoagent = repoagent
         self._cmdsession = cmdcore.nullCmdSession()
-        self._cmdoutputs = []
+        self._cmdoutbuf = bytearray()
         self.error_message = None
+        self._settings = QSettings()
 
+        # imported here so that loading this module for the repository
+        # widget does not pull in the generated form
+        from .postreview_ui import Ui_PostReviewDialog
         self.qui = Ui_PostReviewDialog()
         self.qui.setupUi(self)
 
         self.initChangesets(revs)
         self.readSettings()
 
-        self.review_thread = LoadReviewDataThread(self)
+        # isValid() answers from this flag, updated when its inputs change
+        self._validCached = False
+        self.qui.repo_id_combo.currentTextChanged.connect(self._recomputeValid)
+        self.qui.review_id_combo.currentTextChanged.connect(
+            self._recomputeValid)
+        self._recomputeValid()
+
+        self.review_thread = LoadReviewDataThread(self)  # type: Optional[LoadReviewDataThread]
         self.review_thread.finished.connect(self.errorPrompt)
         self.review_thread.start()
-        QShortcut(QKeySequence('Ctrl+Return'), self, self.accept)
-        QShortcut(QKeySequence('Ctrl+Enter'), self, self.accept)
+        # one action serves both Return keys
+        actionEnter = QAction(self)
+        actionEnter.setShortcuts([Qt.CTRL+Qt.Key_Return, Qt.CTRL+Qt.Key_Enter])
+        actionEnter.triggered.connect(self.accept)
+        self.addAction(actionEnter)
 
     @property
     def repo(self):
@@ -180,13 +195,42 @@ class PostReviewDialog(QDialog):
         self.qui.progress_bar.hide()
         self.qui.progress_label.hide()
 
+        # the loader has done its job; don't keep it for the dialog lifetime
+        thread = self.review_thread
+        if not thread:
+            return  # detached by closeEvent(); the results are discarded
+        self.review_thread = None
+        thread.deleteLater()
+
         if self.error_message:
             qtlib.ErrorMsgBox(_('Review Board'),
                               _('Error'), self.error_message)
             self.close()
-        elif self.isValid():
+            return
+
+        self.loadCombos(thread)
+        if self.isValid():
             self.qui.post_review_button.setEnabled(True)
 
+    def loadCombos(self, thread):
+        # type: (LoadReviewDataThread) -> None
+        #Get the index of a users previously selected repo id
+        index = next((i for i, r in enumerate(thread.repositories)
+                      if r.id == self.repo_id), 0)
+
+        # insert all entries at once, so the combo model is updated once
+        combo = self.qui.repo_id_combo
+        combo.addItems([str(r.id) + ": " + r.name
+                        for r in thread.repositories])
+        if combo.count():
+            combo.setCurrentIndex(index)
+
+        combo = self.qui.review_id_combo
+        combo.addItems([str(r.id) + ": " + r.summary[0:100]
+                        for r in thread.pendingrequests])
+        if combo.count():
+            combo.setCurrentIndex(0)
+
     def closeEvent(self, event):
         # type: (QCloseEvent) -> None
         if not self._cmdsession.isFinished():
@@ -194,29 +238,48 @@ class PostReviewDialog(QDialog):
             event.ignore()
             return
 
-        # Dispose of the review data thread
-        self.review_thread.terminate()
-        self.review_thread.wait()
+        # Detach the review data thread if still loading. It can't be
+        # stopped in the middle of a request, so let it finish on its own
+        # and discard the results instead of blocking the GUI.
+        thread = self.review_thread
+        if thread:
+            self.review_thread = None
+            thread.finished.disconnect(self.errorPrompt)
+            thread.requestInterruption()
+            qtlib.detachThread(thread)
 
         self.writeSettings()
         super(PostReviewDialog, self).closeEvent(event)
 
     def readSettings(self):
         # type: () -> None
-        s = QSettings()
-
-        self.restoreGeometry(qtlib.readByteArray(s, 'reviewboard/geom'))
+        s = self._settings
+
+        # remember the stored values so writeSettings() can skip unchanged ones
+        s.beginGroup('reviewboard')
+        self._savedsettings = saved = {
+            'geom': qtlib.readByteArray(s, 'geom'),
+            'publish_immediately_check':
+                qtlib.readBool(s, 'publish_immediately_check'),
+            'outgoing_changes_check':
+                qtlib.readBool(s, 'outgoing_changes_check'),
+            'branch_check': qtlib.readBool(s, 'branch_check'),
+            'update_fields': qtlib.readBool(s, 'update_fields'),
+            'repo_id': qtlib.readString(s, 'repo_id'),
+            'summary_edit_history':
+                qtlib.readStringList(s, 'summary_edit_history'),
+        }
+        s.endGroup()
+
+        self.restoreGeometry(saved['geom'])
 
         self.qui.publish_immediately_check.setChecked(
-            qtlib.readBool(s, 'reviewboard/publish_immediately_check'))
+            saved['publish_immediately_check'])
         self.qui.outgoing_changes_check.setChecked(
-            qtlib.readBool(s, 'reviewboard/outgoing_changes_check'))
-        self.qui.branch_check.setChecked(
-            qtlib.readBool(s, 'reviewboard/branch_check'))
-        self.qui.update_fields.setChecked(
-            qtlib.readBool(s, 'reviewboard/update_fields'))
-        self.qui.summary_edit.addItems(
-            qtlib.readStringList(s, 'reviewboard/summary_edit_history'))
+            saved['outgoing_changes_check'])
+        self.qui.branch_check.setChecked(saved['branch_check'])
+        self.qui.update_fields.setChecked(saved['update_fields'])
+        self.qui.summary_edit.addItems(saved['summary_edit_history'])
 
         try:
             self.repo_id = int(self.repo.ui.config(b'reviewboard', b'repoid'))
@@ -233,46 +296,64 @@ class PostReviewDialog(QDialog):
 
     def writeSettings(self):
         # type: () -> None
-        s = QSettings()
-        s.setValue('reviewboard/geom', self.saveGeometry())
-        s.setValue('reviewboard/publish_immediately_check',
-                   self.qui.publish_immediately_check.isChecked())
-        s.setValue('reviewboard/branch_check',
-                   self.qui.branch_check.isChecked())
-        s.setValue('reviewboard/outgoing_changes_check',
-                   self.qui.outgoing_changes_check.isChecked())
-        s.setValue('reviewboard/update_fields',
-                   self.qui.update_fields.isChecked())
-        s.setValue('reviewboard/repo_id', self.getRepoId())
-
-        def itercombo(w):
-            if w.currentText():
-                yield w.currentText()
-            for i in pycompat.xrange(w.count()):
-                if w.itemText(i) != w.currentText():
-                    yield w.itemText(i)
-
-        s.setValue('reviewboard/summary_edit_history',
-                   list(itercombo(self.qui.summary_edit))[:10])
+        s = self._settings
+
+        def combohistory(w):
+            # read the combo once, then dedupe on the Python side
+            cur = w.currentText()
+            texts = [w.itemText(i) for i in pycompat.xrange(w.count())]
+            history = [cur] if cur else []
+            history.extend(t for t in texts if t != cur)
+            return history
+
+        values = [
+            ('geom', self.saveGeometry()),
+            ('publish_immediately_check',
+             self.qui.publish_immediately_check.isChecked()),
+            ('branch_check', self.qui.branch_check.isChecked()),
+            ('outgoing_changes_check',
+             self.qui.outgoing_changes_check.isChecked()),
+            ('update_fields', self.qui.update_fields.isChecked()),
+            ('repo_id', self.getRepoId()),
+            ('summary_edit_history',
+             combohistory(self.qui.summary_edit)[:10]),
+        ]
+
+        saved = self._savedsettings
+        s.beginGroup('reviewboard')
+        for key, value in values:
+            if key in saved and saved[key] == value:
+                continue
+            s.setValue(key, value)
+            saved[key] = value
+        s.endGroup()
 
     def initChangesets(self, revs, selected_revs=None):
         # type: (Sequence[Union[bytes, int]], Optional[Sequence[int]]) -> None
-        def purerevs(revs):
-            # type: (Sequence[Union[bytes, int]]) -> Sequence[int]
-            return [r for r in scmutil.revrange(self.repo, revs)]
+        from .hgemail import _ChangesetsModel
+        # TODO: [':'] is inefficient
+        allrevs = self._purerevs(revs or [b':'])
         if selected_revs:
-            selectedrevs = purerevs(selected_revs)
+            selectedrevs = self._purerevs(selected_revs)
+        elif revs:
+            selectedrevs = list(allrevs)
         else:
-            selectedrevs = purerevs(revs)
+            selectedrevs = []
 
         self._changesets = _ChangesetsModel(self.repo,
-                                            # TODO: [':'] is inefficient
-                                            revs=purerevs(revs or [b':']),
+                                            revs=allrevs,
                                             selectedrevs=selectedrevs,
                                             parent=self)
 
         self.qui.changesets_view.setModel(self._changesets)
 
+    def _purerevs(self, revs):
+        # type: (Sequence[Union[bytes, int]]) -> List[int]
+        if all(isinstance(r, int) for r in revs):
+            # already revision numbers, e.g. taken back from the model
+            return list(revs)
+        return list(scmutil.revrange(self.repo, revs))
+
     @property
     def selectedRevs(self):
         # type: () -> List[int]
@@ -333,21 +414,27 @@ class PostReviewDialog(QDialog):
     def isValid(self):
         # type: () -> bool
         """Filled all required values?"""
-        if not self.qui.repo_id_combo.currentText():
-            return False
+        return self._validCached
 
-        if self.qui.tab_widget.currentIndex() == 1:
+    @pyqtSlot()
+    def _recomputeValid(self):
+        # type: () -> None
+        valid = True
+        if not self.qui.repo_id_combo.currentText():
+            valid = False
+        elif self.qui.tab_widget.currentIndex() == 1:
             if not self.qui.review_id_combo.currentText():
-                return False
+                valid = False
 
         if not self.allRevs:
-            return False
+            valid = False
 
-        return True
+        self._validCached = valid
 
     @pyqtSlot()
     def tabChanged(self):
         # type: () -> None
+        self._recomputeValid()
         self.qui.post_review_button.setEnabled(self.isValid())
 
     @pyqtSlot()
@@ -370,11 +457,12 @@ class PostReviewDialog(QDialog):
         # type: () -> None
         branch = self.qui.branch_check.isChecked()
         outgoing = self.qui.outgoing_changes_check.isChecked()
+        # only the check states change, so keep the model and its view
         if branch or outgoing:
-            self.initChangesets(self.allRevs, [self.selectedRevs.pop()])
+            self._changesets.setSelectedRevs([self.selectedRevs.pop()])
             self.qui.changesets_view.setEnabled(False)
         else:
-            self.initChangesets(self.allRevs, self.allRevs)
+            self._changesets.setSelectedRevs(self.allRevs)
             self.qui.changesets_view.setEnabled(True)
 
     def close(self):
@@ -396,12 +484,15 @@ class PostReviewDialog(QDialog):
             # type: (Dict[Text, Union[bool, Text]]) -> List[Text]
             args = []
             for k, v in opts.items():
+                flag = '--%s' % k.replace('_', '-')
                 if isinstance(v, bool):
                     if v:
-                        args.append('--%s' % k.replace('_', '-'))
+                        args.append(flag)
+                elif hglib.isbasestring(v):
+                    args += [flag, v]
                 else:
-                    for e in hglib.isbasestring(v) and [v] or v:
-                        args += ['--%s' % k.replace('_', '-'), e]
+                    for e in v:
+                        args += [flag, e]
 
             return args
 
@@ -414,7 +505,7 @@ class PostReviewDialog(QDialog):
 
         cmdline = ['postreview'] + cmdargs(opts) + [revstr]
         self._cmdsession = sess = self._repoagent.runCommand(cmdline, self)
-        del self._cmdoutputs[:]
+        del self._cmdoutbuf[:]
         sess.commandFinished.connect(self.onCompletion)
         sess.outputReceived.connect(self._captureOutput)
 
@@ -424,17 +515,16 @@ class PostReviewDialog(QDialog):
         self.qui.progress_bar.hide()
         self.qui.progress_label.hide()
 
-        output = hglib.fromunicode(''.join(self._cmdoutputs), 'replace')
+        output = self._cmdoutbuf
 
         saved = b'saved:' in output
         published = b'published:' in output
         if saved or published:
             if saved:
-                url = hglib.tounicode(output.split(b'saved: ').pop().strip())
+                url = hglib.tounicode(_lastfield(output, b'saved: '))
                 msg = _('Review draft posted to %s\n') % url
             else:
-                url = output.split(b'published: ').pop().strip()
-                url = hglib.tounicode(url)
+                url = hglib.tounicode(_lastfield(output, b'published: '))
                 msg = _('Review published to %s\n') % url
 
             QDesktopServices.openUrl(QUrl(url))
@@ -442,7 +532,7 @@ class PostReviewDialog(QDialog):
             qtlib.InfoMsgBox(_('Review Board'), _('Success'),
                                msg, parent=self)
         else:
-            error = output.split(b'abort: ').pop().strip()
+            error = _lastfield(output, b'abort: ')
             if error[:29] == b"HTTP Error: basic auth failed":
                 if self.passwordPrompt():
                     self.accept()
@@ -461,7 +551,7 @@ class PostReviewDialog(QDialog):
     def _captureOutput(self, msg, label):
         # type: (Text, Text) -> None
         if label != 'control':
-            self._cmdoutputs.append(pycompat.unicode(msg))
+            self._cmdoutbuf += hglib.fromunicode(msg, 'replace')
 
     @pyqtSlot()
     def onSettingsButtonClicked(self):
@@ -8,6 +8,7 @@
 from __future__ import absolute_import
 
 from .qtcore import (
+    QElapsedTimer,
     QTimer,
     pyqtSlot,
 )
@@ -45,6 +46,10 @@ if hglib.TYPE_CHECKING:
     )
 
 
+# fixed part of the command listing the target revisions
+_QUERY_CMDLINE = hglib.buildcmdargs('log', T='{rev}\n')
+
+
 class PruneWidget(cmdui.AbstractCmdWidget):
 
     def __init__(self, repoagent, parent=None):
@@ -82,6 +87,12 @@ class PruneWidget(cmdui.AbstractCmdWidget):
         # slightly longer delay than common keyboard auto-repeat rate
         self._querylater = QTimer(self, interval=550, singleShot=True)
         self._querylater.timeout.connect(self._updateRevset)
+        # measures the gap between edits to wait longer while typing fast
+        self._editclock = QElapsedTimer()
+        # revset of the running query, and of the last successful one
+        self._queryrevset = None  # type: Optional[Text]
+        self._lastQueriedRevset = None  # type: Optional[Text]
+        repoagent.repositoryChanged.connect(self._forgetLastQuery)
 
         self._revedit.setFocus()
 
@@ -105,20 +116,37 @@ class PruneWidget(cmdui.AbstractCmdWidget):
     def _onRevsetEdited(self):
         # type: () -> None
         self._querysess.abort()
+        fast = self._editclock.isValid() and self._editclock.elapsed() < 100
+        self._editclock.start()
+        self._querylater.setInterval(fast and 750 or 550)
         self._querylater.start()
         self.commandChanged.emit()
 
     @pyqtSlot()
     def _updateRevset(self):
         # type: () -> None
-        self._querysess.abort()
         self._querylater.stop()
-        cmdline = hglib.buildcmdargs('log', rev=self.revset(), T='{rev}\n')
+        revset = self.revset()
+        sess = self._querysess
+        if (revset == self._lastQueriedRevset and sess.isFinished()
+            and sess.exitCode() == 0):
+            # e.g. edited and reverted; the list already shows its result
+            self.commandChanged.emit()
+            return
+        sess.abort()
+        self._queryrevset = revset
+        cmdline = _QUERY_CMDLINE + ['--rev', revset]
         self._querysess = sess = self._repoagent.runCommand(cmdline, self)
         sess.setCaptureOutput(True)
         sess.commandFinished.connect(self._onQueryFinished)
         self.commandChanged.emit()
 
+    @pyqtSlot()
+    def _forgetLastQuery(self):
+        # type: () -> None
+        # the same revset may now resolve to other revisions
+        self._lastQueriedRevset = None
+
     @pyqtSlot(int)
     def _onQueryFinished(self, ret):
         # type: (int) -> None
@@ -128,8 +156,10 @@ class PruneWidget(cmdui.AbstractCmdWidget):
             return
         if ret == 0:
             revs = pycompat.maplist(int, bytes(sess.readAll()).splitlines())
+            self._lastQueriedRevset = self._queryrevset
         else:
             revs = []
+            self._lastQueriedRevset = None
         self._cslist.update(revs)
         self.commandChanged.emit()
 
@@ -97,6 +97,10 @@ if hglib.TYPE_CHECKING:
         Text,
         Tuple,
         Optional,
+        Set,
+    )
+    from .qtcore import (
+        QThread,
     )
 
 if pycompat.ispy3:
@@ -1210,6 +1214,24 @@ class WidgetGroups(object):
     def set_enable(self, *args, **kargs):
         self.set_prop('setEnabled', *args, **kargs)
 
+# threads detached from their owner, referenced until they are deleted
+_detachedthreads = set()  # type: Set[QThread]
+
+def detachThread(thread):
+    # type: (QThread) -> None
+    """Let a running thread finish on its own once its owner is closed
+
+    The thread is unparented so that it survives the owner, kept referenced
+    until it finishes, and then deleted. The caller should disconnect its
+    slots from the thread beforehand.
+    """
+    thread.setParent(None)
+    _detachedthreads.add(thread)
+    thread.destroyed.connect(lambda *args: _detachedthreads.discard(thread))
+    thread.finished.connect(thread.deleteLater)
+    if thread.isFinished():
+        thread.deleteLater()  # finished before the connection
+
 class DialogKeeper(QObject):
     """Manage non-blocking dialogs identified by creation parameters
 